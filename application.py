@@ -1,13 +1,14 @@
-from flask import Flask, redirect, url_for, request, render_template, make_response, jsonify
+from flask import Flask, Response, redirect, url_for, request, render_template, make_response, jsonify, stream_with_context, send_file
 from urllib.parse import urlencode
-from modules import DBXReader
-import multiprocessing
+from modules import DBXReader, Sharding, Aggregates, Profiling, Tenants, Progress, Replay, Export
+from modules.Cancellation import RunCancelled
+from contextlib import nullcontext
 import requests
-import dropbox
 import gspread
 import base64
 import boto3
 import json
+import time
 import os
 
 
@@ -26,11 +27,23 @@ GOOGLE_TOKENS = "google_tokens.json"
 DBX_OAUTH_SECRETS = "dbx_secrets.json"
 DBX_TOKENS = "dbx_tokens.json"
 DBX_LINK = "dbx_link.txt"
+TENANTS = "tenants.json"
+
+DEFAULT_SHEET = "626_budget_analysis"
 
 GOOGLE_SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-processing_data = None
+CANCEL_GRACE_SECONDS = 120 # how long a preempted run gets to wind down before it is terminated
+PROGRESS_POLL_SECONDS = 1
+PROGRESS_KEEPALIVE_SECONDS = 15
+# a stream holds a worker thread, so it is closed after this long and EventSource reconnects
+# to a fresh one, which keeps a few open processing tabs from starving the webhook and /submit
+PROGRESS_STREAM_SECONDS = 20
+PROGRESS_RECONNECT_MS = 1000
+EXPORT_RETRY_SECONDS = 30
+TERMINAL_STAGES = ("done", "failed", "cancelled")
+scheduler = None
 
-s3 = boto3.client("s3")
+s3 = Replay.s3_client(lambda: boto3.client("s3")) # RECORD_BUNDLE / REPLAY_BUNDLE, see modules/Replay.py
 
 
 # PAGES ————————————————————————————————————————————————————————————————————————————————————————————————————————
@@ -97,14 +110,18 @@ def auth_callback(service):
 
 @application.route('/submit', methods=['POST'])
 def submit():
-    update_dbx_link(request.form['link'])
-    start_processing(force_restart=True)
-    return render_template("processing.html", url=url_for("processing"), message="Your data is being processed. This may take some time.")
+    tenant_id = request.form.get("tenant") or Tenants.DEFAULT_TENANT
+    register_tenant(tenant_id, request.form['link'], request.form.get("sheet"))
+    start_processing(tenant_id, force_restart=True, profile=bool(request.args.get("profile")))
+    return redirect(url_for("processing", tenant=tenant_id))
 
 @application.route('/dbx_webhook', methods=["POST"])
 def dbx_webhook():
-    if link_exists():
-        start_processing()
+    # the notification doesn't say which folder changed, every tenant gets a (coalesced) run
+    tenants = get_tenants()
+    if tenants:
+        for tenant_id in tenants:
+            start_processing(tenant_id)
         return "Success"
     else:
         return error(400, "No Link Found")
@@ -112,32 +129,176 @@ def dbx_webhook():
 
 @application.route('/processing/datasets', methods=['GET'])
 def processing():
-    _processing = processing_data and processing_data.is_alive()
-    if _processing:
-        return render_template("processing.html", url=url_for("processing"), delay=3000, message="Your data is still processing...")
-    
-    return "Sucess! Your data has been processed"
+    tenant_id = request.args.get("tenant", Tenants.DEFAULT_TENANT)
+    return render_template("processing.html", events_url=url_for("processing_events", tenant=tenant_id))
+
+@application.route('/processing/events', methods=['GET'])
+def processing_events():
+    '''
+    Server-Sent Events stream of the tenant's run progress. Sends the progress whenever
+    the worker updates it, and an "end" event once the run has finished and nothing is queued.
+    Streams last at most PROGRESS_STREAM_SECONDS, so a worker thread is never held for
+    longer; the browser reconnects on its own when one closes without an "end".
+    '''
+    tenant_id = request.args.get("tenant", Tenants.DEFAULT_TENANT)
+    root = Tenants.tenant_root(tenant_id)
+
+    def events():
+        last_sent = last_event = None
+        closes_at = time.time() + PROGRESS_STREAM_SECONDS
+        yield "retry: %d\n\n" % PROGRESS_RECONNECT_MS
+        while True:
+            status = get_scheduler().status(tenant_id)
+            busy = status["running"] or status["queued"]
+            progress = Progress.read_progress(root) or {"stage": "queued" if busy else "idle"}
+            progress.update(status)
+
+            if progress != last_sent:
+                yield "data: %s\n\n" % json.dumps(progress)
+                last_sent, last_event = progress, time.time()
+            elif time.time() - last_event > PROGRESS_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                last_event = time.time()
+
+            # the scheduler only lets go of a run once its process has exited, a terminal stage
+            # the current run reported ends the stream before that
+            finished = progress["stage"] in TERMINAL_STAGES and progress.get("updated_at", 0) >= (status["run_started_at"] or 0)
+            if not busy or (finished and not status["queued"]):
+                yield "event: end\ndata: %s\n\n" % json.dumps(progress)
+                return
+
+            if time.time() >= closes_at:
+                return
+
+            time.sleep(PROGRESS_POLL_SECONDS)
+
+    response = Response(stream_with_context(events()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no" # nginx would otherwise buffer the stream
+    return response
 
+@application.route('/tenants', methods=['GET'])
+def tenants():
+    return jsonify({
+        tenant_id: {**tenant, **get_scheduler().status(tenant_id)}
+        for tenant_id, tenant in get_tenants().items()
+    })
+
+# ANALYTICS API ————————————————————————————————————————————————————————————————————————————————————————————————————————
+@application.route('/api/variance_by_section', methods=['GET'])
+def variance_by_section():
+    return aggregate_response("variance_by_section")
+
+@application.route('/api/top_payees', methods=['GET'])
+def top_payees():
+    return aggregate_response("top_payees")
+
+@application.route('/api/estimate_vs_actual', methods=['GET'])
+def estimate_vs_actual():
+    return aggregate_response("estimate_vs_actual")
+
+@application.route('/api/payroll_rates', methods=['GET'])
+def payroll_rates():
+    return aggregate_response("payroll_rates")
+
+def aggregate_response(name):
+    tenant_id = request.args.get("tenant", Tenants.DEFAULT_TENANT)
+    path = os.path.join(Tenants.tenant_root(tenant_id), Aggregates.AGGREGATES_PATH)
+    version = Aggregates.aggregates_version(path)
+    if version is None:
+        return error(404, "No aggregates have been materialized yet")
+
+    params = tuple(sorted((key, val) for key, val in request.args.items() if key != "tenant"))
+    response = make_response(Aggregates.query_aggregate(name, version, params, path))
+    response.mimetype = "application/json"
+    response.set_etag(version) # quoted, and answered with a 304 on a matching If-None-Match
+
+    return response.make_conditional(request)
+
+
+# EXPORT ————————————————————————————————————————————————————————————————————————————————————————————————————————
+@application.route('/export/datasets.xlsx', methods=['GET'])
+def export_datasets():
+    tenant_id = request.args.get("tenant", Tenants.DEFAULT_TENANT)
+    root = Tenants.tenant_root(tenant_id)
+    version = Export.dataset_version(root)
+    if version is None:
+        return error(404, "No datasets have been consolidated yet")
+
+    # built by the run that produced this version, never while a request waits
+    path = Export.cached_export(root, version)
+    if path is None:
+        response = error(503, "The export of the latest datasets is still being built")
+        response.headers["Retry-After"] = str(EXPORT_RETRY_SECONDS)
+        return response
+
+    return send_file(
+        os.path.abspath(path), as_attachment=True, download_name="budget_datasets_%s.xlsx" % tenant_id,
+        etag=version, max_age=0
+    )
+
+
+def get_scheduler() -> Tenants.TenantScheduler:
+    global scheduler
+    if scheduler is None: # created on first use so importing this module doesn't start it
+        scheduler = Tenants.TenantScheduler(process_data, grace_s=CANCEL_GRACE_SECONDS)
+    return scheduler
+
+def start_processing(tenant_id=Tenants.DEFAULT_TENANT, force_restart=False, profile=False) -> bool:
+    tenant = get_tenants().get(tenant_id)
+    if not tenant:
+        return False
 
-def start_processing(force_restart=False):
-    global processing_data
-    _processing = processing_data and processing_data.is_alive()
+    profile = profile or bool(os.environ.get("PROFILE_RUNS"))
+    # a forced restart asks the tenant's current run to stop at its next checkpoint,
+    # the new run starts once the old one has let go of the tenant's caches
+    return get_scheduler().submit(tenant_id, {"tenant": tenant, "profile": profile}, preempt=force_restart)
 
-    if not _processing: # Check if not currently processing
-        processing_data = multiprocessing.Process(target=process_data)
-        processing_data.start()
-    elif force_restart and _processing: # if already processing and need to override
-        processing_data.terminate()
-        processing_data = multiprocessing.Process(target=process_data)
-        processing_data.start()
 
+def process_data(tenant:dict, cancel_token=None, profile=False, memory_budget=None):
+    root = tenant["root"]
+    if os.environ.get("REPLAY_BUNDLE"):
+        root = Replay.replay_root(root) # replays start from the caches the recording started from
+    elif os.environ.get("RECORD_BUNDLE"):
+        Replay.snapshot_caches(root, os.environ["RECORD_BUNDLE"])
+    Progress.clear_progress(root)
+    progress = Progress.ProgressReporter(Progress.progress_path(root))
 
-def process_data():
-    populate_environ_tokens()
-    dbx = dropbox.Dropbox(os.environ["dbx_access_token"])
-    dbx_reader = DBXReader.DbxDataRetriever(os.environ["dbx_link"], dbx)
-    dbx_reader.create_datasets()
-    upload_dfs_to_google_sheet(dbx_reader.datasets, "626_budget_analysis")
+    try:
+        populate_environ_tokens()
+        populate_dbx_app_keys()
+        num_shards = int(os.environ.get("NUM_SHARDS", 1))
+
+        with Profiling.profile_run(os.path.join(root, Profiling.PROFILES_PATH)) if profile else nullcontext() as run_dir:
+            if num_shards > 1:
+                progress.stage("processing")
+                dbx_reader = Sharding.run_sharded(tenant["link"], os.environ["dbx_access_token"], num_shards, cancel_token=cancel_token, root=root, progress=progress, memory_budget=memory_budget, profile_dir=run_dir)
+            else:
+                dbx = Replay.dropbox_client(os.environ["dbx_access_token"])
+                dbx_reader = DBXReader.DbxDataRetriever(tenant["link"], dbx, memory_budget=memory_budget, cancel_token=cancel_token, root=root, progress=progress)
+                dbx_reader.create_datasets(exact_stats=bool(os.environ.get("EXACT_STATS")))
+
+        if run_dir:
+            Profiling.write_slowest_files(dbx_reader.file_timings, run_dir)
+
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled() # the preempting run will publish
+        progress.stage("exporting")
+        Export.build_export(root)
+        progress.stage("publishing")
+        publish_datasets(dbx_reader, tenant["sheet"])
+        progress.stage("done", eta_s=0)
+    except RunCancelled:
+        progress.stage("cancelled")
+        print("processing run cancelled, finished projects were checkpointed")
+    except Exception as e:
+        progress.error(repr(e))
+        progress.stage("failed")
+        raise
+
+def publish_datasets(dbx_reader, sheet_name=DEFAULT_SHEET) -> None:
+    print(dbx_reader.memory_report())
+    upload_dfs_to_google_sheet({**dbx_reader.datasets, **dbx_reader.rollups}, sheet_name)
 
 # HELPERS ————————————————————————————————————————————————————————————————————————————————————————————————————————
 def dbx_auth_url() -> str:
@@ -271,6 +432,16 @@ def populate_environ_tokens() -> None:
         for token in ["access_token", "refresh_token"]:
             os.environ["%s_%s" % (service, token)] = tokens[token]
 
+def populate_dbx_app_keys() -> None:
+    # lets the Dropbox client refresh an expired access token by itself mid-run
+    try:
+        secrets = get_dbx_secrets()
+    except Exception as e:
+        print("no dbx app keys, the access token won't be refreshed:", repr(e))
+        return
+    os.environ["dbx_app_key"] = secrets["client_id"]
+    os.environ["dbx_app_secret"] = secrets["client_secret"]
+
 def upload_dfs_to_google_sheet(dfs:dict, sheet_name:str):
     gc = create_gspread_client()
 
@@ -289,24 +460,35 @@ def upload_dfs_to_google_sheet(dfs:dict, sheet_name:str):
             worksheet.clear()
             worksheet.update_title(df_name)
         except gspread.WorksheetNotFound:
-            worksheet = sheet.add_worksheet(df_name, len(df), len(df.columns))
+            worksheet = sheet.add_worksheet(df_name, max(len(df), 1), max(len(df.columns), 1))
         
-        worksheet.update([df.columns.values.tolist()] + df.values.tolist())
+        worksheet.update(df_to_sheet_values(df))
 
     # sheet.share(share_email, "user", "writer", notify=False)
 
+def df_to_sheet_values(df) -> list:
+    # typed columns (dates, categories, float32) aren't JSON serializable as is
+    df = df.copy()
+    for col in df.select_dtypes(include=["datetime"]).columns:
+        df[col] = df[col].dt.strftime("%Y-%m-%d")
+    df = df.astype(object).where(df.notna(), "")
+
+    return [df.columns.values.tolist()] + df.values.tolist()
+
 def create_gspread_client():
-    secrets = get_google_secrets()
-    auth_user = {
-        "refresh_token": os.environ.get("google_refresh_token"),
-        "token_uri": secrets["token_uri"],
-        "client_id": secrets["client_id"],
-        "client_secret": secrets["client_secret"],
-    }
+    def connect():
+        secrets = get_google_secrets()
+        auth_user = {
+            "refresh_token": os.environ.get("google_refresh_token"),
+            "token_uri": secrets["token_uri"],
+            "client_id": secrets["client_id"],
+            "client_secret": secrets["client_secret"],
+        }
 
-    gc, _ = gspread.oauth_from_dict(authorized_user_info=auth_user)
+        gc, _ = gspread.oauth_from_dict(authorized_user_info=auth_user)
+        return gc
 
-    return gc
+    return Replay.gspread_client(connect)
 
 def link_exists() -> bool:
     if os.environ.get("dbx_link"):
@@ -323,6 +505,35 @@ def update_dbx_link(link) -> None:
     os.environ["dbx_link"] = link
     s3.put_object(Bucket=BUCKET, Key=DBX_LINK, Body=link)
 
+def get_tenants() -> dict:
+    '''
+    Registered tenants by id. The link saved before there were tenants is the default tenant.
+    '''
+    try:
+        tenants = json.loads(s3.get_object(Bucket=BUCKET, Key=TENANTS)["Body"].read())
+    except:
+        tenants = {}
+
+    if not Tenants.DEFAULT_TENANT in tenants and link_exists():
+        tenants[Tenants.DEFAULT_TENANT] = {"link": os.environ["dbx_link"], "sheet": DEFAULT_SHEET}
+
+    for tenant_id, tenant in tenants.items():
+        tenant["root"] = Tenants.tenant_root(tenant_id)
+
+    return tenants
+
+def register_tenant(tenant_id, link, sheet=None) -> None:
+    if tenant_id == Tenants.DEFAULT_TENANT:
+        update_dbx_link(link)
+        sheet = sheet or DEFAULT_SHEET
+
+    tenants = get_tenants()
+    tenants[tenant_id] = {"link": link, "sheet": sheet or tenants.get(tenant_id, {}).get("sheet") or "%s_budget_analysis" % tenant_id}
+    for tenant in tenants.values():
+        tenant.pop("root", None) # derived from the id
+
+    s3.put_object(Bucket=BUCKET, Key=TENANTS, Body=json.dumps(tenants))
+
 def error(num, message):
     status_code = num
     message = message
@@ -0,0 +1,165 @@
+from functools import lru_cache
+import pandas as pd
+import os
+
+
+AGGREGATES_PATH = "aggregates"
+VERSION_FILE = "version.txt"
+
+
+# AGGREGATE TABLES ——————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————
+def has_columns(_df:pd.DataFrame, columns:list) -> bool:
+    return not _df.empty and all(col in _df.columns for col in columns)
+
+def variance_by_section_year(cs:pd.DataFrame) -> pd.DataFrame:
+    if not has_columns(cs, ["SECTION", "DATE", "BID TOTALS", "ACTUAL", "VARIANCE"]):
+        return pd.DataFrame()
+
+    _df = cs.assign(YEAR=pd.to_datetime(cs.DATE, errors="coerce").dt.year.astype("Int64"))
+    _df = _df.groupby(["SECTION", "YEAR"], observed=True).agg(**{
+        "BID TOTALS": ("BID TOTALS", "sum"),
+        "ACTUAL": ("ACTUAL", "sum"),
+        "VARIANCE": ("VARIANCE", "sum"),
+        "PROJECTS": ("PROJECT NAME", "nunique"),
+    }).reset_index()
+    _df["VARIANCE (%)"] = _df["VARIANCE"] / (_df["BID TOTALS"] + 1E-5) * 100
+
+    return _df
+
+def top_payees(po:pd.DataFrame) -> pd.DataFrame:
+    if not has_columns(po, ["PAYEE", "ACTUAL"]):
+        return pd.DataFrame()
+
+    _df = po.groupby("PAYEE", observed=True).agg(**{
+        "ACTUAL": ("ACTUAL", "sum"),
+        "ORDERS": ("ACTUAL", "size"),
+        "PROJECTS": ("PROJECT NAME", "nunique"),
+    }).reset_index()
+
+    return _df.sort_values("ACTUAL", ascending=False, ignore_index=True)
+
+def estimate_vs_actual(cs:pd.DataFrame) -> pd.DataFrame:
+    if not has_columns(cs, ["PROJECT NAME", "BID TOTALS", "ACTUAL"]):
+        return pd.DataFrame()
+
+    _df = cs.groupby("PROJECT NAME", observed=True).agg(**{
+        "ESTIMATE": ("BID TOTALS", "sum"),
+        "ACTUAL": ("ACTUAL", "sum"),
+    }).reset_index()
+    _df["VARIANCE"] = _df["ACTUAL"] - _df["ESTIMATE"]
+    _df["VARIANCE (%)"] = _df["VARIANCE"] / (_df["ESTIMATE"] + 1E-5) * 100
+
+    return _df
+
+def payroll_rates(pr:pd.DataFrame) -> pd.DataFrame:
+    if not has_columns(pr, ["SECTION", "RATE"]):
+        return pd.DataFrame()
+
+    rates = pr[pr.RATE > 0].groupby("SECTION", observed=True).RATE
+    _df = rates.describe(percentiles=[0.1, 0.25, 0.5, 0.75, 0.9]).reset_index()
+
+    return _df.rename(columns=str.upper)
+
+
+# name -> (builder, source dataset, columns that can be filtered on with query params)
+AGGREGATES = {
+    "variance_by_section" : (variance_by_section_year, "CS", ["SECTION", "YEAR"]),
+    "top_payees" : (top_payees, "PO", ["PAYEE"]),
+    "estimate_vs_actual" : (estimate_vs_actual, "CS", ["PROJECT NAME"]),
+    "payroll_rates" : (payroll_rates, "PR", ["SECTION"]),
+}
+
+
+# ROLLUP WORKSHEETS —————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————
+def section_project_totals(cs:pd.DataFrame) -> pd.DataFrame:
+    if not has_columns(cs, ["PROJECT NAME", "SECTION", "BID TOTALS", "ACTUAL", "VARIANCE"]):
+        return pd.DataFrame()
+
+    return cs.groupby(["PROJECT NAME", "SECTION"], observed=True)[["BID TOTALS", "ACTUAL", "VARIANCE"]].sum().reset_index()
+
+def payee_spend_by_month(po:pd.DataFrame) -> pd.DataFrame:
+    if not has_columns(po, ["PAYEE", "DATE", "ACTUAL"]):
+        return pd.DataFrame()
+
+    _df = po.assign(MONTH=pd.to_datetime(po.DATE, errors="coerce").dt.to_period("M").astype(str))
+    _df = _df.groupby(["PAYEE", "MONTH"], observed=True).agg(**{
+        "ACTUAL": ("ACTUAL", "sum"),
+        "ORDERS": ("ACTUAL", "size"),
+    }).reset_index()
+
+    return _df.sort_values(["MONTH", "ACTUAL"], ascending=[True, False], ignore_index=True)
+
+def variance_percentiles(cs:pd.DataFrame) -> pd.DataFrame:
+    if not has_columns(cs, ["SECTION", "VARIANCE (%)"]):
+        return pd.DataFrame()
+
+    percentiles = [0.1, 0.25, 0.5, 0.75, 0.9]
+    _df = cs.groupby("SECTION", observed=True)["VARIANCE (%)"].quantile(percentiles).unstack()
+    _df.columns = ["P%d" % (p * 100) for p in percentiles]
+
+    return _df.reset_index()
+
+
+# worksheet title -> (builder, source dataset)
+ROLLUPS = {
+    "ROLLUP SECTION x PROJECT" : (section_project_totals, "CS"),
+    "ROLLUP PAYEE x MONTH" : (payee_spend_by_month, "PO"),
+    "ROLLUP VARIANCE PERCENTILES" : (variance_percentiles, "CS"),
+}
+
+def compute_rollups(datasets:dict) -> dict:
+    return {name: builder(datasets.get(_type, pd.DataFrame())) for name, (builder, _type) in ROLLUPS.items()}
+
+
+# MATERIALIZATION ———————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————
+def materialize_aggregates(datasets:dict, path=AGGREGATES_PATH) -> dict:
+    '''
+    Builds every aggregate table from the consolidated datasets and writes them to path.
+    The version file is written last so readers never see a half written set.
+    '''
+    os.makedirs(path, exist_ok=True)
+    tables = {}
+
+    for name, (builder, _type, _) in AGGREGATES.items():
+        tables[name] = builder(datasets.get(_type, pd.DataFrame()))
+        tmp_path = os.path.join(path, "%s.pickle.tmp" % name)
+        tables[name].to_pickle(tmp_path)
+        os.replace(tmp_path, os.path.join(path, "%s.pickle" % name))
+
+    with open(os.path.join(path, VERSION_FILE), "w") as f:
+        f.write(str(pd.Timestamp.now().value))
+
+    return tables
+
+def aggregates_version(path=AGGREGATES_PATH):
+    try:
+        with open(os.path.join(path, VERSION_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+@lru_cache(maxsize=len(AGGREGATES) * 2)
+def load_aggregate(name:str, version:str, path=AGGREGATES_PATH) -> pd.DataFrame:
+    return pd.read_pickle(os.path.join(path, "%s.pickle" % name))
+
+@lru_cache(maxsize=512)
+def query_aggregate(name:str, version:str, params:tuple, path=AGGREGATES_PATH) -> str:
+    '''
+    Returns the filtered aggregate as a JSON string. Cached per (version, params),
+    so hot dashboard queries never touch pandas; a new materialization changes
+    the version and naturally invalidates the cache.
+    '''
+    _df = load_aggregate(name, version, path)
+    filters = AGGREGATES[name][2]
+    params = dict(params)
+
+    for col in filters:
+        value = params.get(col.lower().replace(" ", "_"))
+        if value is not None and col in _df.columns:
+            _df = _df[_df[col].astype(str).str.lower() == value.lower()]
+
+    limit = params.get("limit")
+    if limit and limit.isdigit():
+        _df = _df.head(int(limit))
+
+    return _df.to_json(orient="records")
@@ -0,0 +1,56 @@
+from concurrent.futures import ProcessPoolExecutor
+from modules.MemoryBudget import default_budget
+from modules.Storage import LocalBackend
+from modules import Sharding
+import argparse
+import time
+import os
+
+
+BACKFILL_ROOT = "backfill"
+
+
+def backfill(source:str, out:str, root=BACKFILL_ROOT, workers=None, exact_stats=False) -> dict:
+    '''
+    Runs classify -> parse -> consolidate over a local directory tree, one shard per
+    worker process, and writes the consolidated datasets to out as parquet.
+    '''
+    workers = workers or os.cpu_count()
+    link = "home/" # path_from_link turns this into the root folder "/"
+    storage = LocalBackend(source)
+    shards_dir = os.path.join(root, Sharding.SHARDS_PATH)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(Sharding.run_shard, link, None, shard, workers, shards_dir, root, storage, default_budget() // workers)
+            for shard in range(workers)
+        ]
+        partial_dirs = [future.result() for future in futures]
+
+    dbx_reader = Sharding.merge_shards(link, storage, partial_dirs, exact_stats, root)
+
+    os.makedirs(out, exist_ok=True)
+    paths = {}
+    for _type, df in dbx_reader.datasets.items():
+        paths[_type] = os.path.join(out, "%s.parquet" % _type)
+        df.to_parquet(paths[_type], index=False)
+
+    return paths
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Ingest a local copy of the project folders without going through Dropbox.")
+    parser.add_argument("source", help="directory with one sub-directory per project")
+    parser.add_argument("--out", default="backfill_out", help="where the CS / CSSS / PR / PO parquet files are written")
+    parser.add_argument("--root", default=BACKFILL_ROOT, help="cache namespace, a tenant's root adds the projects to its history")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to every core")
+    parser.add_argument("--exact-stats", action="store_true")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    paths = backfill(args.source, args.out, args.root, args.workers, args.exact_stats)
+    print("backfilled in %.1fs:" % (time.perf_counter() - start), paths)
+
+
+if __name__ == "__main__":
+    main()
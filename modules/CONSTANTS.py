@@ -41,7 +41,101 @@ HB_PDF_SECTION_LOCS = {
     'EDITORIAL | FINISHING | POST PRODUCTION': (7, 1),
 }
 
+# Money, rate and day columns the readers parse as accounting-formatted numbers
+NUMERIC_COLS = [
+    "DAYS", "RATE", "BASE", "1.5", "2", "3", "TAXABLE", "NON-TAX", "TOTAL ST", "TOTAL OT",
+    "ACTUAL", "FRINGE 1", "FRINGE 2", "BID TOTALS", "ESTIMATE", "VARIANCE"
+]
+
+# Concurrent tenant runs on the host (MAX_WORKERS overrides), and how long a run's lease lasts
+# without a heartbeat before another web worker may take the tenant over
+TENANT_WORKERS = 2
+RUN_LEASE_SECONDS = 60
+
+# Trigram similarity a new payee string needs to be merged into a known payee without review.
+# Strings scoring at least PAYEE_REVIEW_SCORE but under it stay their own payee, and the
+# closest known one is exported as a merge candidate for review.
+PAYEE_MATCH_THRESHOLD = 0.85
+PAYEE_REVIEW_SCORE = 0.5
+
 FILE_PREFERENCE = [".xlsx", ".xlsb", ".pdf"]
+SNIFF_CELLS = 400 # cells read from the top of a sheet when classifying it
+
+# Rows of a cached dataset held in memory at a time while streaming the Excel export
+EXPORT_CHUNK_ROWS = 50_000
+
+# Size at which the per-file trace log rotates, and how many rotated files are kept
+TRACE_MAX_BYTES = 10 * 2**20
+TRACE_BACKUPS = 5
+
+# Memory admission for processing runs. The budget defaults to a fraction of system memory
+# (MEMORY_BUDGET_MB overrides it), a project costs roughly PARSE_EXPANSION times the size of
+# its parseable files, and admissions pause above the high watermark until under the low one.
+MEMORY_BUDGET_FRACTION = 0.5
+MEMORY_WATERMARKS = (0.65, 0.85)
+PARSE_EXPANSION = 8
+PROJECT_OVERHEAD_BYTES = 16 * 2**20
+
+# Column the VARIANCE (%) outlier pass groups by, per dataset
+OUTLIER_KEYS = {
+    "CS" : "SECTION",
+    "PR" : "SECTION",
+    "CSSS" : "SUB SECTION",
+}
+
+# VARIANCE (%) as parsed, before any outlier pass replaced it. Kept in the cached history
+# so the sketches and exact=True rebuild from the real values, never published.
+RAW_VARIANCE_COL = "VARIANCE (%) RAW"
+
+# Most recently updated projects per section whose sketch is kept apart, so re-processing one
+# replaces its values. Older projects are folded into the section's settled sketch.
+SECTION_STATS_OPEN_PROJECTS = 100
+
+# Column dtypes enforced on every dataset as it leaves the readers. Money stays float64 so totals
+# don't drift, day counts and percentages are safe as float32.
+DATASET_SCHEMAS = {
+    "CS" : {
+        "SECTION": "category",
+        "BID TOTALS": "float64",
+        "ACTUAL": "float64",
+        "VARIANCE": "float64",
+        "VARIANCE (%)": "float32",
+        "VARIANCE (%) RAW": "float32",
+        "DATE": "datetime64[ns]",
+        "PROJECT NAME": "category",
+    },
+    "CSSS" : {
+        "SECTION": "category",
+        "SUB SECTION": "category",
+        "DAYS": "float32",
+        "RATE": "float64",
+        "ESTIMATE": "float64",
+        "ACTUAL": "float64",
+        "VARIANCE": "float64",
+        "VARIANCE (%)": "float32",
+        "VARIANCE (%) RAW": "float32",
+        "DATE": "datetime64[ns]",
+        "PROJECT NAME": "category",
+    },
+    "PR" : {
+        "SECTION": "category",
+        "PAYEE": "category",
+        "RATE": "float64",
+        "EST": "float64",
+        "ACTUAL": "float64",
+        "VARIANCE": "float64",
+        "VARIANCE (%)": "float32",
+        "VARIANCE (%) RAW": "float32",
+        "PROJECT NAME": "category",
+    },
+    "PO" : {
+        "SECTION": "category",
+        "PAYEE": "category",
+        "DATE": "datetime64[ns]",
+        "ACTUAL": "float64",
+        "PROJECT NAME": "category",
+    },
+}
 
 
 restaurants = (
@@ -0,0 +1,26 @@
+import multiprocessing
+
+
+class RunCancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    '''
+    Shared flag that asks a processing run to stop at its next checkpoint.
+    Backed by a multiprocessing.Event, so it can be set from the Flask process
+    and seen inside the run's process.
+    '''
+    def __init__(self, event=None) -> None:
+        self.event = event or multiprocessing.Event()
+
+    def cancel(self) -> None:
+        self.event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        if self.event.is_set():
+            raise RunCancelled()
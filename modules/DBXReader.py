@@ -1,9 +1,31 @@
-from concurrent.futures import ThreadPoolExecutor, wait
-from modules import CONSTANTS
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from xml.etree.ElementTree import iterparse
+from contextlib import contextmanager, nullcontext
+from collections import Counter
+from bisect import bisect_right
+from modules.FileIndex import FileRecord, FileIndex
+from modules.Sketches import SectionStats
+from modules.Manifest import FileManifest, row_matches
+from modules.Cancellation import CancellationToken, RunCancelled
+from modules.MemoryBudget import MemoryBudget, estimate_project_cost
+from modules.PayeeStore import PayeeStore, normalize_payee, categorize_payee
+from modules.Progress import ProgressReporter, progress_path
+from modules.Storage import as_backend
+from modules.Trace import FileTrace, TraceLog, trace_path, current_file, note_error
+from functools import partial
+from modules import CONSTANTS, Aggregates
 import pandas as pd
 import numpy as np
 import tempfile
-import dropbox
+import threading
+import zipfile
+import glob
+import gc
+import io
+import shutil
+import time
+import uuid
+import hashlib
 import camelot
 import pickle
 import fitz
@@ -11,10 +33,33 @@ import os
 import re
 
 # HELPER FUNCTIONS ——————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————
+# file_obj is either a path to a downloaded file or the file's bytes
+
+def open_pdf(file_obj):
+    if isinstance(file_obj, str):
+        return fitz.open(file_obj)
+    return fitz.open(stream=file_obj)
+
+@contextmanager
+def pdf_path(file_obj):
+    '''
+    Yields a path camelot can read, spilling bytes to a temp file only when needed.
+    '''
+    if isinstance(file_obj, str):
+        yield file_obj
+        return
+
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_pdf:
+        temp_pdf.write(file_obj)
+    try:
+        yield temp_pdf.name
+    finally:
+        os.remove(temp_pdf.name)
+
 def get_content(extension, file_obj):
     if extension == ".pdf":
-        reader = fitz.open(stream=file_obj)
-        return reader.load_page(0).get_text()
+        with open_pdf(file_obj) as reader:
+            return reader.load_page(0).get_text()
     elif extension == ".xlsx":
         return pd.read_excel(file_obj).to_string()
     elif extension == ".xlsb":
@@ -22,6 +67,89 @@ def get_content(extension, file_obj):
     else:
         return None
 
+def iter_xml(archive:zipfile.ZipFile, name:str):
+    with archive.open(name) as f:
+        for _, elem in iterparse(f):
+            yield elem.tag.rsplit("}", 1)[-1], elem
+
+def first_sheet_name(archive:zipfile.ZipFile) -> str:
+    # the first <sheet> in workbook.xml is the one pd.read_excel opens by default
+    try:
+        sheet = next(elem for tag, elem in iter_xml(archive, "xl/workbook.xml") if tag == "sheet")
+        rel_id = next(val for key, val in sheet.attrib.items() if key.endswith("}id"))
+        for tag, elem in iter_xml(archive, "xl/_rels/workbook.xml.rels"):
+            if tag == "Relationship" and elem.get("Id") == rel_id:
+                return "xl/" + elem.get("Target").lstrip("/").removeprefix("xl/")
+    except (KeyError, StopIteration):
+        pass
+
+    return "xl/worksheets/sheet1.xml"
+
+def sniff_xlsx(file_obj, max_cells:int) -> str:
+    '''
+    Reads the first max_cells cells of the first sheet straight from the xlsx zip,
+    then only as much of the shared-strings part as those cells reference.
+    '''
+    texts, shared_idxs = [], {}
+
+    with zipfile.ZipFile(file_obj if isinstance(file_obj, str) else io.BytesIO(file_obj)) as archive:
+        for tag, elem in iter_xml(archive, first_sheet_name(archive)):
+            if tag != "c":
+                continue
+
+            value = next((child.text for child in elem.iter() if child.tag.rsplit("}", 1)[-1] in ("v", "t")), None)
+            if value is not None and elem.get("t") == "s":
+                shared_idxs[int(value)] = len(texts)
+                texts.append("")
+            elif value is not None:
+                texts.append(value)
+            elem.clear()
+
+            if len(texts) >= max_cells:
+                break
+
+        if shared_idxs and "xl/sharedStrings.xml" in archive.namelist():
+            idx, last_idx = 0, max(shared_idxs)
+            for tag, elem in iter_xml(archive, "xl/sharedStrings.xml"):
+                if tag != "si":
+                    continue
+                if idx in shared_idxs:
+                    texts[shared_idxs[idx]] = "".join(t.text or "" for t in elem.iter() if t.tag.endswith("}t"))
+                elem.clear()
+
+                idx += 1
+                if idx > last_idx:
+                    break
+
+    return " ".join(texts)
+
+def sniff_xlsb(file_obj, max_cells:int) -> str:
+    from pyxlsb import open_workbook
+
+    texts = []
+    with open_workbook(file_obj if isinstance(file_obj, str) else io.BytesIO(file_obj)) as workbook:
+        with workbook.get_sheet(1) as sheet:
+            for row in sheet.rows():
+                texts += [str(cell.v) for cell in row if cell.v is not None]
+                if len(texts) >= max_cells:
+                    break
+
+    return " ".join(texts)
+
+def sniff_content(extension, file_obj, max_cells=CONSTANTS.SNIFF_CELLS):
+    '''
+    Cheap stand-in for get_content when only looking for keywords: the first page
+    of a pdf, or the first few hundred cells of a sheet.
+    '''
+    if extension == ".pdf":
+        return get_content(extension, file_obj)
+    elif extension == ".xlsx":
+        return sniff_xlsx(file_obj, max_cells)
+    elif extension == ".xlsb":
+        return sniff_xlsb(file_obj, max_cells)
+    else:
+        return None
+
 def contains(string:str, contains:list) -> bool:
     for cont in contains:
         if cont in string:
@@ -29,28 +157,44 @@ def contains(string:str, contains:list) -> bool:
     
     return False
 
+def classify_name(path):
+    file_name = path.split("/")[-1].lower()
+    if contains(file_name, ["po log", "purchase order"]):
+        return "PO"
+    
+    return None
+
+def classify_content(path, file_obj) -> str:
+    '''
+    Classifies from a sniff of the file's content. Unlike classify_file, errors are raised.
+    '''
+    extension = os.path.splitext(path)[1]
+    content = sniff_content(extension, file_obj)
+    if content is None:
+        return "OTHER"
+
+    content = content.lower()
+    if "purchase order" in content:
+        return "PO"
+    elif contains(content, ["cost summary", "hot budget", "film production cost summary"]):
+        return "CS"
+    elif "wrapbook" in content:
+        return "OTHER"
+    elif "payroll" in content:
+        return "PR"
+    else:
+        return "OTHER"
+
 def classify_file(path, file_obj, verbose=False):
     try:
-        file_name = path.split("/")[-1].lower()
-        if contains(file_name, ["po log", "purchase order"]):
-            return "PO"
-
-        extension = os.path.splitext(path)[1]
-        content = get_content(extension, file_obj)
-
-        content = content.lower()
-        if "purchase order" in content:
-            return "PO"
-        elif contains(content, ["cost summary", "hot budget", "film production cost summary"]):
-            return "CS"
-        elif "wrapbook" in content:
-            return "OTHER"
-        elif "payroll" in content:
-            return "PR"
-        else:
-            return "OTHER"
+        _type = classify_name(path)
+        if _type:
+            return _type
+
+        return classify_content(path, file_obj)
     except Exception as e:
         print("classification error %s at: " % e, path) if verbose else None
+        note_error(e, "classify")
         return "OTHER"
 
 def get_section_from_line(ln:int) -> str:
@@ -78,16 +222,62 @@ def find_outliers_iqr(SERIES, threshold=1.5):
 
     return outliers
 
+def replace_outliers(_df:pd.DataFrame, key:str, stats:SectionStats, _type:str) -> pd.DataFrame:
+    '''
+    Replaces VARIANCE (%) outliers with the section median, using the persisted
+    section sketches so the bounds reflect the whole history.
+    '''
+    for section, idx in _df.groupby(key, observed=True).groups.items():
+        lower, upper, median = stats.bounds(_type, section)
+        values = _df.loc[idx, "VARIANCE (%)"]
+        outliers = values[(values < lower) | (values > upper)]
+        _df.loc[outliers.index, "VARIANCE (%)"] = median
+
+    return _df
+
+def replace_outliers_exact(_df:pd.DataFrame, key:str) -> pd.DataFrame:
+    for section in _df[key].unique():
+        section_df = _df[_df[key] == section]
+        outliers = find_outliers_iqr(section_df["VARIANCE (%)"])
+        _df.loc[outliers.index, "VARIANCE (%)"] = section_df["VARIANCE (%)"].median()
+
+    return _df
+
+class SheetLayout:
+    '''
+    Cell value -> row positions of a sheet read with a RangeIndex, built in one pass so
+    header and section searches don't rescan the whole frame. Lookups mirror get_row_idx,
+    including falling back to the first row when the value isn't found.
+    '''
+    def __init__(self, _df:pd.DataFrame) -> None:
+        values = _df.to_numpy()
+        rows, cols = np.nonzero(pd.notna(values))
+        self.n_rows = len(_df)
+        self.nonblank = set(rows.tolist())
+        self.rows = {} # value -> ascending row positions
+        for row, value in zip(rows.tolist(), values[rows, cols].tolist()):
+            self.rows.setdefault(value, []).append(row)
+
+    def first_row(self, key, after=-1, default=0) -> int:
+        rows = self.rows.get(key, [])
+        i = bisect_right(rows, after)
+        return rows[i] if i < len(rows) else default
+
+    def first_blank_row(self, start:int) -> int:
+        row = start
+        while row < self.n_rows and row in self.nonblank:
+            row += 1
+        return row if row < self.n_rows else start
+
 def get_row_idx(_df:pd.DataFrame, key:str) -> int:
     try:
         return (_df == key).any(axis=1).idxmax()
     except ValueError:
         return 0
 
-def camelot_read_pdf_bytes(file_obj, table_num=0) -> pd.DataFrame:
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_pdf:
-        temp_pdf.write(file_obj)
-        return camelot.read_pdf(temp_pdf.name)._tables[table_num].df.copy()
+def camelot_read_pdf(file_obj, table_num=0) -> pd.DataFrame:
+    with pdf_path(file_obj) as path:
+        return camelot.read_pdf(path)._tables[table_num].df.copy()
 
 def read_sheet(file_obj, extension:str) -> pd.DataFrame:
     if extension == ".xlsx":
@@ -95,21 +285,56 @@ def read_sheet(file_obj, extension:str) -> pd.DataFrame:
     elif extension == ".xlsb":
         _df = pd.read_excel(file_obj, engine='pyxlsb')
     
-    start = get_row_idx(_df, "LINE")
+    layout = SheetLayout(_df)
+    start = layout.first_row("LINE")
     if not "ACTUAL" in _df.iloc[start]:
         _df.columns = _df.iloc[start].fillna(_df.iloc[start-1])
-        end = _df[start:].isna().all(axis=1).idxmax()
+        end = layout.first_blank_row(start)
         _df = _df.iloc[start+1 : end]
     else:
         _df.columns = _df.iloc[start]
         _df = _df.iloc[start+1]
 
-    _df.dropna(subset=["LINE", "PAYEE"], inplace=True)
-    _df = _df.replace(["\)", ","], "", regex=True).replace("\(", "-", regex=True)
-
-    if "RATE" in _df.columns:
-        _df.RATE = _df.RATE.astype(float)
+    _df = _df.dropna(subset=["LINE", "PAYEE"])
     
+    return parse_numeric_cols(_df)
+
+def parse_numeric(series:pd.Series) -> tuple:
+    '''
+    Parses an accounting-formatted column: "$1,234.50", "(1,234)" for negatives, "-" for zero.
+    Cells that are already numbers skip the string work. Returns the float values and a
+    mask of the non-blank cells that could not be parsed.
+    '''
+    values = pd.to_numeric(series, errors="coerce")
+    todo = values.isna() & series.notna()
+    if not todo.any():
+        return values.astype(float), todo
+
+    text = series[todo].astype(str)
+    cleaned = text.str.replace(r"[\s$,()]", "", regex=True).replace("-", "0")
+    parsed = pd.to_numeric(cleaned, errors="coerce")
+    parsed = parsed.where(~text.str.contains("(", regex=False), -parsed)
+
+    values = values.astype(float)
+    values[todo] = parsed
+    unparsed = todo.copy()
+    unparsed[todo] = parsed.isna() & (cleaned != "")
+
+    return values, unparsed
+
+def parse_numeric_cols(_df:pd.DataFrame, cols=CONSTANTS.NUMERIC_COLS) -> pd.DataFrame:
+    '''
+    Runs parse_numeric over the columns of cols present in _df. Values that could not be
+    parsed become NaN and their row labels are kept in _df.attrs["unparsed"].
+    '''
+    unparsed = {}
+    for col in [col for col in cols if col in _df.columns]:
+        _df[col], bad = parse_numeric(_df[col])
+        if bad.any():
+            unparsed[col] = list(_df.index[bad])
+
+    if unparsed:
+        _df.attrs["unparsed"] = unparsed
     return _df
 
 def replaced(_list:list, idxs:list, values:list) -> list:
@@ -119,11 +344,115 @@ def replaced(_list:list, idxs:list, values:list) -> list:
 
     return ret_list
 
+def enforce_schema(_df:pd.DataFrame, _type:str) -> pd.DataFrame:
+    '''
+    Casts the columns of a dataset to the dtypes in CONSTANTS.DATASET_SCHEMAS.
+    Columns missing from the frame are skipped, unparseable values become NaN / NaT.
+    '''
+    schema = CONSTANTS.DATASET_SCHEMAS.get(_type, {})
+
+    for col, dtype in schema.items():
+        if not col in _df.columns or _df[col].dtype == dtype:
+            continue
+
+        if dtype == "category":
+            _df[col] = _df[col].astype("category")
+        elif dtype.startswith("datetime"):
+            _df[col] = pd.to_datetime(_df[col], errors="coerce")
+        else:
+            _df[col] = pd.to_numeric(_df[col], errors="coerce").astype(dtype)
+
+    return _df
+
+def concat_typed(dfs:list, _type:str) -> pd.DataFrame:
+    '''
+    pd.concat falls back to object dtype when categoricals have different categories,
+    so the categories are unioned first to keep the result compact.
+    '''
+    schema = CONSTANTS.DATASET_SCHEMAS.get(_type, {})
+    dfs = list(dfs)
+
+    is_cat = lambda df, col: col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype)
+
+    for col, dtype in schema.items():
+        if dtype != "category":
+            continue
+        categories = list(dict.fromkeys(cat for df in dfs if is_cat(df, col) for cat in df[col].cat.categories))
+        dfs = [df.assign(**{col: df[col].cat.set_categories(categories)}) if is_cat(df, col) else df for df in dfs]
+
+    return enforce_schema(pd.concat(dfs, ignore_index=True), _type)
+
+def shard_of(project_name:str, num_shards:int) -> int:
+    # md5 instead of hash() so every process / node agrees on the assignment
+    digest = hashlib.md5(project_name.encode("utf-8")).hexdigest()
+    return int(digest, 16) % num_shards
+
+class SingleFlight:
+    '''
+    Run-scoped duplicate suppression. Concurrent calls with the same key share a single
+    execution, and the result is held only until every expected caller has received it.
+    Keys expected fewer than two times skip the bookkeeping entirely.
+    '''
+    def __init__(self, expected:Counter=None) -> None:
+        self.lock = threading.Lock()
+        self.expected = Counter(expected or {})
+        self.futures = {}
+
+    def do(self, key, fn, *args):
+        if key is None or self.expected.get(key, 0) < 2:
+            return fn(*args)
+
+        with self.lock:
+            future = self.futures.get(key)
+            owner = future is None
+            if owner:
+                future = self.futures[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        try:
+            return future.result()
+        finally:
+            with self.lock:
+                self.expected[key] -= 1
+                if self.expected[key] <= 0:
+                    self.futures.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.futures.clear()
+
+def memory_report(datasets:dict, peak_rss=None) -> pd.DataFrame:
+    '''
+    Rows, columns and memory per dataset. peak_rss (bytes) adds the process peak as a last row.
+    '''
+    report = []
+    for _type, df in datasets.items():
+        if isinstance(df, list):
+            df = pd.concat(df, ignore_index=True) if df else pd.DataFrame()
+        usage = df.memory_usage(deep=True)
+        report.append({
+            "DATASET": _type,
+            "ROWS": len(df),
+            "COLUMNS": len(df.columns),
+            "MEMORY (MB)": round(usage.sum() / 1E6, 3),
+            "LARGEST COLUMN": usage.drop("Index").idxmax() if len(df.columns) else None,
+        })
+
+    if peak_rss:
+        report.append({"DATASET": "PEAK RSS", "MEMORY (MB)": round(peak_rss / 1E6, 3)})
+
+    return pd.DataFrame(report)
+
 
 # COST SUMMARY FUNCTIONS ————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————
 def read_hot_budget_cs(file_obj, extension) -> pd.DataFrame:
     if extension == ".pdf":
-        _df = camelot_read_pdf_bytes(file_obj, 1)
+        _df = camelot_read_pdf(file_obj, 1)
         
         _df.drop(12, inplace=True)
 
@@ -131,9 +460,10 @@ def read_hot_budget_cs(file_obj, extension) -> pd.DataFrame:
         _df.drop(columns=["drop"], inplace=True)
         _df = _df.loc[1:]
 
-        _df = _df.replace([r"CS\d+\b ", r".*\n", "\)"], "", regex=True).replace("\(", "-", regex=True)
-
-        _df[_df.columns[1:]] = _df.iloc[:, 1:].replace("", np.nan).apply(lambda x: x.str.replace(',', '')).astype(float)
+        # camelot merges wrapped cells, only the last line of each is kept
+        _df = _df.replace(r".*\n", "", regex=True)
+        _df.SECTION = _df.SECTION.replace([r"CS\d+\b ", "\)"], "", regex=True).replace("\(", "-", regex=True)
+        _df = parse_numeric_cols(_df)
 
         _df = _df.dropna(thresh=2)
 
@@ -151,7 +481,7 @@ def read_hot_budget_cs(file_obj, extension) -> pd.DataFrame:
             date = "REPLACE"
 
 
-        start = get_row_idx(_df, "ESTIMATED COST SUMMARY")
+        start = SheetLayout(_df).first_row("ESTIMATED COST SUMMARY")
         _df.columns = _df.iloc[start]
         _df = _df.iloc[start+1: start + 24]
 
@@ -171,8 +501,8 @@ def read_hot_budget_cs(file_obj, extension) -> pd.DataFrame:
         return pd.DataFrame()
 
 def read_GetActual_cs(file_obj) -> pd.DataFrame:
-    reader = fitz.open(stream=file_obj)
-    content = reader.load_page(0).get_text()
+    with open_pdf(file_obj) as reader:
+        content = reader.load_page(0).get_text()
 
     start = re.search(r"\b[A-Z]\s", content[2:]).start()
     content = re.sub(r"\b[A-Z]\s|Bid Actual|\,|\)", "", content.replace("(", "-"))
@@ -204,12 +534,23 @@ def clean_SECTION(val:str) -> str:
     
     return val.upper()
 
-def read_cost_summary(file_obj, extension) -> pd.DataFrame:
-    content = get_content(extension, file_obj)
-    
+def cost_summary_format(content:str):
     if "ESTIMATED COST SUMMARY" in content:
-        _df = read_hot_budget_cs(file_obj, extension)
+        return "hot budget"
     elif "Film Production Cost Summary" in content:
+        return "GetActual"
+    return None
+
+def read_cost_summary(file_obj, extension) -> pd.DataFrame:
+    # the sniff finds the marker in the top of nearly every summary, the whole sheet is only
+    # read when it doesn't
+    _format = cost_summary_format(sniff_content(extension, file_obj) or "")
+    if _format is None:
+        _format = cost_summary_format(get_content(extension, file_obj) or "")
+
+    if _format == "hot budget":
+        _df = read_hot_budget_cs(file_obj, extension)
+    elif _format == "GetActual":
         _df = read_GetActual_cs(file_obj)
     else:
         return pd.DataFrame()
@@ -218,6 +559,7 @@ def read_cost_summary(file_obj, extension) -> pd.DataFrame:
     _df.SECTION = _df.SECTION.apply(clean_SECTION)
     
     _df["VARIANCE (%)"] = _df["VARIANCE"] / (_df["BID TOTALS"] + 1E-5) * 100
+    _df[CONSTANTS.RAW_VARIANCE_COL] = _df["VARIANCE (%)"]
 
     for section in _df["SECTION"].unique():
         section_df = _df[_df["SECTION"] == section]
@@ -228,12 +570,18 @@ def read_cost_summary(file_obj, extension) -> pd.DataFrame:
 
 
 # CS SUBSECTION FUNCTIONS ———————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————
+def xlsx_section_block(_df, layout:SheetLayout, section) -> pd.DataFrame:
+    '''
+    The rows between a section's header row and its SUB TOTAL, headed by the header row.
+    '''
+    start = layout.first_row(section)
+    end = layout.first_row("SUB TOTAL", after=start, default=start + 1)
+
+    block = _df.iloc[start+1 : end].reset_index(drop=True)
+    block.columns = _df.iloc[start]
+    return block
+
 def clean_xlsx_section_df(section_df, section) -> pd.DataFrame:
-    start = get_row_idx(section_df, section)
-    section_df.columns = section_df.iloc[start]
-    section_df = section_df.iloc[start+1:].reset_index(drop=True)
-    section_df = section_df[:get_row_idx(section_df, "SUB TOTAL")]
-    
     section_df = section_df[replaced(CONSTANTS.CS_SUBSECTION_COLS, [0, 1], [section_df.columns[0], section])]
     section_df.columns = CONSTANTS.CS_SUBSECTION_COLS
     section_df = section_df.dropna(thresh=3).reset_index(drop=True).fillna(0.0)
@@ -250,11 +598,13 @@ def clean_xlsx_section_df(section_df, section) -> pd.DataFrame:
 def get_HB_xlsx_secion_dfs(cs, file_obj) -> pd.DataFrame:
     section_dfs = []
     _df = pd.read_excel(file_obj, header=37)
+    layout = SheetLayout(_df)
 
     for section in cs.SECTION.unique():
         try:
-            section_dfs.append(clean_xlsx_section_df(_df.copy(), section))
-        except:
+            section_dfs.append(clean_xlsx_section_df(xlsx_section_block(_df, layout, section), section))
+        except Exception as e:
+            note_error(e, "sections")
             continue
 
     return pd.concat(section_dfs, ignore_index=True)
@@ -286,10 +636,7 @@ def clean_pdf_section_df(section_df) -> pd.DataFrame:
     section_df = section_df[replaced(CONSTANTS.CS_SUBSECTION_COLS, [0, 1], [section_df.columns[0], section])]
     section_df.columns = CONSTANTS.CS_SUBSECTION_COLS
 
-    section_df["ESTIMATE"] = section_df["ESTIMATE"].str.replace(',', '')
-    section_df["ACTUAL"] = section_df["ACTUAL"].str.replace(',', '')
-
-    section_df[["DAYS", "RATE", "ESTIMATE", "ACTUAL"]] = section_df[["DAYS", "RATE", "ESTIMATE", "ACTUAL"]].apply(pd.to_numeric, errors="coerce")
+    section_df = parse_numeric_cols(section_df.copy())
     section_df = section_df.dropna(subset="ACTUAL").reset_index(drop=True).fillna(0.0)
 
     section_df.insert(0, "SECTION", section)
@@ -302,10 +649,9 @@ def clean_pdf_section_df(section_df) -> pd.DataFrame:
 def get_HB_pdf_section_dfs(cs, file_obj):
     section_dfs = []
 
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_pdf:
-        temp_pdf.write(file_obj)
+    with pdf_path(file_obj) as path:
         for page_num, table_nums in to_read(cs.SECTION.unique()).items():
-            for table in camelot.read_pdf(temp_pdf.name, pages=str(page_num))._tables:
+            for table in camelot.read_pdf(path, pages=str(page_num))._tables:
                 if table.order in table_nums:
                     section_dfs.append(clean_pdf_section_df(table.df))
 
@@ -329,7 +675,7 @@ def get_CS_section_dfs(cs, file_obj, extension) -> pd.DataFrame:
 
 # PAYROLL FUNCTIONS —————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————
 def read_pdf_payroll(file_obj) -> pd.DataFrame:
-    _df = camelot_read_pdf_bytes(file_obj, 0)
+    _df = camelot_read_pdf(file_obj, 0)
     
     _df.columns = CONSTANTS.PR_COLS
     _df = _df.iloc[1:].reset_index(drop=True).replace("", np.nan).dropna(how="all")
@@ -337,10 +683,7 @@ def read_pdf_payroll(file_obj) -> pd.DataFrame:
     _df.LINE.fillna(_df.PAYEE, inplace=True)
     _df[['LINE', 'PAYEE']] = _df.LINE.str.split(" ", n=1, expand=True)
 
-    _df = _df.replace(["\)", ","], "", regex=True).replace("\(", "-", regex=True)
-    _df.ACTUAL = _df.ACTUAL.astype(float)
-
-    return _df
+    return parse_numeric_cols(_df)
 
 def read_payroll(file_obj, extension) -> pd.DataFrame:
     if extension == ".pdf":
@@ -364,9 +707,7 @@ def read_payroll(file_obj, extension) -> pd.DataFrame:
 
 # PURCHASE ORDER LOG FUNCTIONS ——————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————
 def read_pdf_purchase_order(file_obj) -> pd.DataFrame:
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_pdf:
-        temp_pdf.write(file_obj)
-        _df = camelot.read_pdf(temp_pdf.name)._tables[0].df.copy()
+    _df = camelot_read_pdf(file_obj, 0)
     
     _df.columns = CONSTANTS.PO_COLS
     _df = _df.iloc[1:].reset_index(drop=True).replace("", np.nan).dropna(how="all")
@@ -377,28 +718,15 @@ def read_pdf_purchase_order(file_obj) -> pd.DataFrame:
     _df.ACTUAL.fillna(_df["LINE DESCRIPTION"], inplace=True)
     _df[['ACTUAL', 'LINE DESCRIPTION']] = _df.ACTUAL.str.split(" ", n=1, expand=True)
 
-    _df = _df.replace(["\)", ","], "", regex=True).replace("\(", "-", regex=True)
-
-    return _df
+    return parse_numeric_cols(_df)
 
 def clean_payee(payee) -> str:
-    payee = payee.split("-")[0].lower()
-
-    for sub in CONSTANTS.subs:
-        payee = re.sub(sub[0], sub[1], payee)
-    payee = payee.strip()
-    
-    for cat in CONSTANTS.categories:
-        if contains(payee, cat[0]):
-            payee = cat[2]
-            break
-        elif payee in cat[1]:
-            payee = cat[2]
-            break
+    payee = normalize_payee(payee)
+    payee = categorize_payee(payee) or payee
 
     return payee.strip().title()
 
-def read_purchase_order(file_obj, extension) -> pd.DataFrame:
+def read_purchase_order(file_obj, extension, payee_store:PayeeStore=None) -> pd.DataFrame:
 
     if extension == ".pdf":
         _df = read_pdf_purchase_order(file_obj)
@@ -414,36 +742,72 @@ def read_purchase_order(file_obj, extension) -> pd.DataFrame:
     _df["SECTION"] = _df.LINE.apply(get_section_from_line)
     _df["LINE DESCRIPTION"] =_df["LINE DESCRIPTION"].fillna("NA")
 
-    _df["DATE"] = _df["DATE"].fillna(_df["DATE"].median()).dt.date.astype(str)
+    dates = pd.to_datetime(_df["DATE"], errors="coerce")
+    _df["DATE"] = dates.fillna(dates.median()).dt.normalize()
 
-    _df.PAYEE = _df.PAYEE.apply(clean_payee)
+    if payee_store:
+        _df.PAYEE = payee_store.resolve_many(_df.PAYEE)
+    else:
+        _df.PAYEE = _df.PAYEE.apply(clean_payee)
     
     try:
         return _df[['LINE', 'SECTION', 'PAYEE', 'DATE', 'ACTUAL', 'LINE DESCRIPTION']]
-    except:
+    except Exception as e:
+        note_error(e, "parse")
         return pd.DataFrame()
 
 # DBX RETRIEVER CLASS ———————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————————
 class DbxDataRetriever:
-    cache_path = "dbx_retrieval_cache.pickle"
     df_caches_path = "df_caches"
-    chunk_path = "dbx_reader_chunks.pickle"
+    checkpoints_path = "checkpoints"
 
-    def __init__(self, link, dbx, clear_cache=False, chunk_size=50) -> None:
+    def __init__(self, link, storage, clear_cache=False, memory_budget=None, shard=None, cancel_token=None, root="", progress=None) -> None:
         self.path = self.path_from_link(link)
-        self.chunk_size = chunk_size
-        self.dbx = dbx
+        self.root = root # cache namespace, every cache path below lives under it
+        self.memory_budget = memory_budget # bytes, see MemoryBudget
+        self.shard = shard # (index, count) when only processing part of the projects
+        self.cancel_token = cancel_token or CancellationToken()
+        self.storage = as_backend(storage) # a StorageBackend, a Dropbox client is wrapped in DropboxBackend
         self.dbx_files = {}
-        self.cache = {}
+        if root:
+            os.makedirs(root, exist_ok=True)
+        self.df_caches_path = os.path.join(root, self.df_caches_path)
+        self.checkpoints_path = os.path.join(root, self.checkpoints_path)
+        self.aggregates_path = os.path.join(root, Aggregates.AGGREGATES_PATH)
+        self.manifest = FileManifest(os.path.join(root, FileManifest.path))
+        self.section_stats = SectionStats(os.path.join(root, SectionStats.path))
+        self.payees = PayeeStore(os.path.join(root, PayeeStore.path))
+        self.progress = progress or ProgressReporter(progress_path(root, shard[0] if shard else None))
+        self.trace_log = TraceLog(trace_path(root, shard[0] if shard else None))
+        self.run_id = uuid.uuid4().hex[:8]
+        self.downloads = SingleFlight()
+        self.classifications = SingleFlight()
+        self.parses = SingleFlight()
+        self.blob_refs = Counter()
+        self.blob_paths = {}
+        self.blob_lock = threading.Lock()
+        self.scratch_dir = None
+        self.file_timings = []
+        self.peak_rss = 0 # bytes, of the processing step, see MemoryBudget
+        self.resumed = {} # path -> manifest row a shard checkpointed but no merge has committed yet
+        self.readers = {
+            "CS" : read_cost_summary,
+            "PR" : read_payroll,
+            "PO" : partial(read_purchase_order, payee_store=self.payees)
+        }
         self.datasets = {
             "CS" : [],
             "CSSS" : [],
             "PR" : [],
             "PO" : []
         }
+        self.rollups = {}
 
-        if not os.path.isdir(self.df_caches_path):
-            os.mkdir(self.df_caches_path)
+        if shard:
+            self.checkpoints_path = os.path.join(self.checkpoints_path, "shard_%d" % shard[0])
+
+        os.makedirs(self.df_caches_path, exist_ok=True)
+        os.makedirs(self.checkpoints_path, exist_ok=True)
         
         if clear_cache:
             self.clear_cache()
@@ -451,7 +815,9 @@ class DbxDataRetriever:
             self.load_cache()
         
     def clear_cache(self) -> None:
-        self.cache = {}
+        self.manifest.clear()
+        self.section_stats.clear()
+        self.payees.clear()
         self.save_cache()
         for file in os.listdir(self.df_caches_path):
             os.remove(os.path.join(self.df_caches_path, file))
@@ -477,45 +843,205 @@ class DbxDataRetriever:
         return path[start : end]
 
     def load_cache(self) -> None:
-        if os.path.exists(self.cache_path):
-            with open(self.cache_path, "rb") as f:
-                self.cache = pickle.load(f)
+        self.section_stats.load()
     
     def save_cache(self) -> None:
-        with open(self.cache_path, 'wb') as f:
-            pickle.dump(self.cache, f)
+        self.manifest.flush()
+        self.payees.flush()
+        self.section_stats.save()
     
-    def cache_and_check(self, metadata) -> bool:
+    def cache_and_check(self, metadata, project=None) -> bool:
         '''
         Returns True if the given file hase been previously cached, 
         and False if it has not been cached previously. It also 
         caches the file if not.
         '''
-        file_name = metadata.name
-        date = str(metadata.client_modified)
-        cached_date = self.cache.get(file_name)
-
-        if cached_date == date:
+        resumed = self.resumed.get(metadata.path_display)
+        if self.manifest.is_unchanged(metadata) or (resumed and row_matches(resumed, metadata)):
             return True
         else:
-            self.cache[file_name] = date
+            self.manifest.stage_file(metadata, project)
             return False
 
-    def get_file(self, dbx_path):
-        _meta, res = self.dbx.files_download(dbx_path)
-        file_obj = res.content
-        _type = classify_file(dbx_path, file_obj, verbose=False)
+    def in_shard(self, project_name:str) -> bool:
+        if not self.shard:
+            return True
+        
+        index, count = self.shard
+        return shard_of(project_name, count) == index
+
+    def download_file(self, dbx_path) -> str:
+        '''
+        Streams the file into the run's scratch directory instead of holding it in memory.
+        Returns the local path, which is what the readers take as file_obj.
+        '''
         extension = os.path.splitext(dbx_path)[1]
+        file_obj = os.path.join(self.scratch_dir, uuid.uuid4().hex + extension)
+        self.cancel_token.raise_if_cancelled()
+        start = time.perf_counter()
+        trace = current_file.get()
+        with trace.phase("download") if trace else nullcontext():
+            self.storage.read_to_file(dbx_path, file_obj)
+        self.manifest.stage(dbx_path, download_s=time.perf_counter() - start)
+
+        return file_obj
+
+    def load_blob(self, dbx_path, key) -> str:
+        file_obj = self.downloads.do(key, self.download_file, dbx_path)
+        with self.blob_lock:
+            self.blob_paths[key] = file_obj
+
+        return file_obj
 
-        return _type, extension, file_obj
+    def classify(self, record:FileRecord) -> str:
+        '''
+        Classifies by file name when possible, so only files that need it are downloaded.
+        '''
+        _type = classify_name(record.path)
+        if not _type and record.content_hash:
+            _type = self.manifest.get_classification(record.content_hash)
+        if not _type:
+            key = record.content_hash or record.path
+            _type = self.classifications.do(key, self.classify_and_remember, record)
+
+        self.manifest.stage(record.path, type=_type)
+        return _type
+
+    def classify_and_remember(self, record:FileRecord) -> str:
+        '''
+        Content classifications are persisted by content hash so a blob is only ever
+        sniffed once. Failures fall back to OTHER without being remembered.
+        '''
+        try:
+            _type = classify_content(record.path, record.file_obj)
+        except Exception as e:
+            note_error(e, "classify")
+            return "OTHER"
+
+        if record.content_hash:
+            self.manifest.put_classification(record.content_hash, _type)
+        return _type
+
+    def open_scratch(self) -> None:
+        self.scratch_dir = tempfile.mkdtemp(prefix="dbx_scratch_", dir=os.environ.get("SCRATCH_DIR"))
+
+    def close_scratch(self) -> None:
+        if self.scratch_dir:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            self.scratch_dir = None
+
+    def release_files(self, records) -> None:
+        '''
+        Deletes downloaded files once no other project still references the same blob.
+        '''
+        for record in records:
+            key = record.content_hash or record.path
+            record.release()
+            with self.blob_lock:
+                self.blob_refs[key] -= 1
+                if self.blob_refs[key] > 0:
+                    continue
+                file_obj = self.blob_paths.pop(key, None)
+
+            if file_obj and os.path.exists(file_obj):
+                os.remove(file_obj)
+
+    def spill(self) -> None:
+        '''
+        Called under memory pressure. Drops the parsed frames held for projects sharing a
+        blob (they re-parse it from the scratch copy), outputs are already in the checkpoints.
+        '''
+        self.parses.clear()
+        gc.collect()
+
+    def share_blobs(self) -> None:
+        '''
+        Producers copy the same log into several project folders, so downloads and
+        classifications are shared across projects by Dropbox content_hash for the length
+        of the run. Parses are shared once the files are classified, see share_parses.
+        '''
+        hashes = Counter(
+            entry.content_hash or entry.path_display for entries in self.dbx_files.values() for entry in entries
+            if not entry.is_dir
+        )
+        self.downloads = SingleFlight(hashes)
+        self.classifications = SingleFlight(hashes)
+        self.blob_refs = hashes.copy()
+        self.blob_paths = {}
+
+    def share_parses(self, chosen:dict) -> None:
+        '''
+        Parses are keyed by (content_hash, type), and (content_hash, "CSSS") for the cost
+        summary sections, so they are expected once per project that chose the file.
+        '''
+        keys = Counter()
+        for files in chosen.values():
+            for _type, file in files.items():
+                if file:
+                    key = file.content_hash or file.path
+                    keys[(key, _type)] += 1
+                    if _type == "CS":
+                        keys[(key, "CSSS")] += 1
+
+        self.parses = SingleFlight(keys)
+
+    def index_projects(self, projects:list) -> tuple:
+        '''
+        Classifies the files of every project before any are parsed, so that it is known
+        which projects parse the same file. Returns each project's FileIndex and chosen files.
+        '''
+        with ThreadPoolExecutor() as executor:
+            indexes = dict(zip(projects, executor.map(lambda name: self.get_files_from_project(self.dbx_files[name], name), projects)))
+
+        chosen = {}
+        for project_name, files in indexes.items():
+            chosen[project_name] = {_type: self.select_best_file(_type, files) for _type in self.datasets}
+            self.release_files([record for record in files if not record in chosen[project_name].values()])
+
+        self.share_parses(chosen)
+        return indexes, chosen
+
+    def parse_file(self, file:FileRecord) -> pd.DataFrame:
+        key = (file.content_hash or file.path, file._type)
+        parser = self.parser_name(file._type, file.extension)
+        file.trace.set(parser=parser)
+        start = time.perf_counter()
+        try:
+            with file.trace.phase("parse"):
+                _df = self.parses.do(key, self.file_to_df, file._type, file.extension, file.file_obj)
+        except Exception:
+            self.manifest.stage(file.path, parse_status="failed", parse_s=time.perf_counter() - start)
+            raise
+
+        seconds = time.perf_counter() - start
+        file.trace.record["rows"][file._type] = len(_df)
+        file.trace.record["unparsed"] = {col: len(rows) for col, rows in _df.attrs.get("unparsed", {}).items()}
+        status = "empty" if _df.empty else "parsed"
+        self.manifest.stage(file.path, parse_status=status, parse_s=seconds)
+        self.progress.file_parsed()
+        self.record_timing(file, parser, seconds)
+        return _df.copy()
+    
+    def parse_sections(self, cs:pd.DataFrame, file:FileRecord) -> pd.DataFrame:
+        key = (file.content_hash or file.path, "CSSS")
+        start = time.perf_counter()
+        with file.trace.phase("sections"):
+            csss = self.parses.do(key, get_CS_section_dfs, cs, file.file_obj, file.extension)
+        file.trace.record["rows"]["CSSS"] = len(csss)
+        self.record_timing(file, "get_CS_section_dfs%s" % file.extension, time.perf_counter() - start)
+        return csss.assign(DATE=cs.DATE[0]) # the date can depend on the project name
+
+    def record_timing(self, file:FileRecord, parser:str, seconds:float) -> None:
+        self.file_timings.append({"path": file.path, "type": file._type, "parser": parser, "size": file.size, "seconds": seconds})
+
+    def parser_name(self, _type:str, extension:str) -> str:
+        reader = self.readers.get(_type)
+        return "%s%s" % (getattr(reader, "func", reader).__name__, extension) if reader else "none"
 
     def file_to_df(self, _type:str, extension:str, file_obj:bytes) -> pd.DataFrame:
-        if _type == "CS":
-            return read_cost_summary(file_obj, extension)
-        elif _type == "PR":
-            return read_payroll(file_obj, extension)
-        elif _type == "PO":
-            return read_purchase_order(file_obj, extension)
+        reader = self.readers.get(_type)
+        if reader:
+            return reader(file_obj, extension)
         else:
             return pd.DataFrame()
 
@@ -523,65 +1049,69 @@ class DbxDataRetriever:
         if files is None:
             files = []
             
-        res = self.dbx.files_list_folder(path)
+        entries = self.storage.list(path)
 
         def process_entry(entry):
             file_path = entry.path_display
-            if isinstance(entry, dropbox.files.FileMetadata):
-                files.append(entry)
-            elif isinstance(entry, dropbox.files.FolderMetadata):
+            if entry.is_dir:
                 self.ls_files_in_dir(file_path, files)
+            else:
+                files.append(entry)
         
         with ThreadPoolExecutor() as executor:
             # Submit file processing tasks to the executor
-            futures = [executor.submit(process_entry, entry) for entry in res.entries]
+            futures = [executor.submit(process_entry, entry) for entry in entries]
             # Wait for all tasks to complete
             wait(futures)
         
         return files
 
     def create_files(self) -> None:
-        res = self.dbx.files_list_folder(self.path) # gets a list of all the projects in the main dir
+        entries = self.storage.list(self.path) # gets a list of all the projects in the main dir
 
         def process_entry(entry):
-            if isinstance(entry, dropbox.files.FolderMetadata):
+            self.cancel_token.raise_if_cancelled()
+            if entry.is_dir and self.in_shard(entry.name):
                 dir_files = self.ls_files_in_dir(entry.path_display) # lists all the files in the projct dir
                 if dir_files:
-                    cache_check = [self.cache_and_check(file) for file in dir_files]
+                    cache_check = [self.cache_and_check(file, entry.name) for file in dir_files]
                     if False in cache_check:
                         self.dbx_files[entry.name] = dir_files
 
         with ThreadPoolExecutor() as executor:
             # Submit file processing tasks to the executor
-            futures = [executor.submit(process_entry, entry) for entry in res.entries]
+            futures = [executor.submit(process_entry, entry) for entry in entries]
             # Wait for all tasks to complete
             wait(futures)
+        
+        self.cancel_token.raise_if_cancelled()
 
-    def get_files_from_project(self, entries) -> pd.DataFrame:
-        _df = []
+    def get_files_from_project(self, entries, project_name=None) -> FileIndex:
+        records = []
 
         def process_entry(entry):
             file_path = entry.path_display
-            if isinstance(entry, dropbox.files.FileMetadata):
-                _df.append(self.get_file(file_path))
+            if not entry.is_dir:
+                key = entry.content_hash or file_path
+                record = FileRecord(
+                    file_path, os.path.splitext(file_path)[1], entry.size, entry.content_hash,
+                    lambda: self.load_blob(file_path, key),
+                    trace=FileTrace(file_path, project_name, entry.size, entry.content_hash, self.run_id)
+                )
+                with record.trace.phase("classify"):
+                    record._type = self.classify(record)
+                record.trace.set(type=record._type)
+                records.append(record)
 
         with ThreadPoolExecutor() as executor:
             futures = [executor.submit(process_entry, entry) for entry in entries]
             wait(futures)
 
-        return pd.DataFrame(_df, columns=["_type", "extension", "file_obj"])
+        self.cancel_token.raise_if_cancelled() # a cancelled download leaves the index incomplete
+        return FileIndex(records)
     
-    def select_best_file(self, _type:str, _df:pd.DataFrame):
-        matches = _df[_df._type == _type]
-        if matches.empty:
-            return None
-
-        for extension in CONSTANTS.FILE_PREFERENCE:
-            matches = matches[matches.extension == extension]
-            if not matches.empty:
-                return matches.iloc[0].to_dict()
-        
-        return None
+    def select_best_file(self, _type:str, files:FileIndex):
+        return files.best(_type)
     
     def cache_df(self, df, _type):
         path = os.path.join(self.df_caches_path, "%s.csv" % _type)
@@ -589,31 +1119,36 @@ class DbxDataRetriever:
             df.to_csv(path, index=False)
             return df
 
-        _cache_df = pd.read_csv(path)
+        _cache_df = enforce_schema(pd.read_csv(path), _type)
         if not df.empty:
             _cache_df = _cache_df[~_cache_df['PROJECT NAME'].isin(df["PROJECT NAME"].unique())]
-            _cache_df = pd.concat([_cache_df, df])
+            _cache_df = concat_typed([_cache_df, df], _type)
 
         _cache_df.to_csv(path, index=False)
 
         return _cache_df
 
 
-    def consolidate_datasets(self) -> None:
+    def consolidate_datasets(self, exact=False) -> None:
+        '''
+        Only the new rows are compared against the persisted section sketches, so the
+        cost scales with the projects processed this run. exact=True reconciles by
+        recomputing the outlier pass and the sketches over the whole cached history,
+        from the raw variances the history keeps next to the replaced ones.
+        '''
+        raw = CONSTANTS.RAW_VARIANCE_COL
+
         for _type in self.datasets:
+            key = CONSTANTS.OUTLIER_KEYS.get(_type)
+
             if self.datasets.get(_type):
-                df = pd.concat(self.datasets[_type], ignore_index=True).reset_index(drop=True)
-
-                if _type in ["CS", "PR"]:
-                    for section in df["SECTION"].unique():
-                        section_df = df[df["SECTION"] == section]
-                        outliers = find_outliers_iqr(section_df["VARIANCE (%)"])
-                        df.loc[outliers.index, "VARIANCE (%)"] = section_df["VARIANCE (%)"].median()
-                elif _type == "CSSS":
-                    for section in df["SUB SECTION"].unique():
-                        section_df = df[df["SUB SECTION"] == section]
-                        outliers = find_outliers_iqr(section_df["VARIANCE (%)"])
-                        df.loc[outliers.index, "VARIANCE (%)"] = section_df["VARIANCE (%)"].median()
+                df = concat_typed(self.datasets[_type], _type)
+
+                if key:
+                    # CS keeps the value from before the reader's own per-file pass
+                    df[raw] = df[raw].fillna(df["VARIANCE (%)"]) if raw in df.columns else df["VARIANCE (%)"]
+                    self.section_stats.update(_type, df, key, column=raw)
+                    replace_outliers(df, key, self.section_stats, _type)
                 elif _type != "PO":
                     df["VARIANCE (%)"] = df["VARIANCE (%)"].clip(upper=100)
 
@@ -621,71 +1156,213 @@ class DbxDataRetriever:
             else:
                 self.datasets[_type] = self.cache_df(pd.DataFrame(), _type)
 
-    def cache_current_chunk(self) -> None:
-        datasets = self.load_chunked_dfs()
-        
-        with open(self.chunk_path, 'wb') as f:
-                pickle.dump(datasets, f)
-        
-        self.clear_datasets()
-    
-    def load_chunked_dfs(self) -> dict:
-        if os.path.exists(self.chunk_path):
-            with open(self.chunk_path, 'rb') as f:
-                cached_datasets = pickle.load(f)
-                return {key: self.datasets[key] + cached_datasets[key] for key in self.datasets}
-        else:
-            return self.datasets
-    
-    def clear_chunks_cache(self) -> None:
-        if os.path.exists(self.chunk_path):
-            os.remove(self.chunk_path)
+            if exact and key and not self.datasets[_type].empty:
+                history = self.datasets[_type]
+                if not raw in history.columns: # cached before the raw values were kept
+                    history[raw] = history["VARIANCE (%)"]
+                history[raw] = history[raw].fillna(history["VARIANCE (%)"])
+                history["VARIANCE (%)"] = history[raw]
+
+                self.section_stats.rebuild(_type, history, key, column=raw)
+                self.datasets[_type] = replace_outliers_exact(history, key)
+                history.to_csv(os.path.join(self.df_caches_path, "%s.csv" % _type), index=False)
+
+            # only the cached history keeps the raw values, what is published and aggregated doesn't
+            self.datasets[_type] = self.datasets[_type].drop(columns=[raw], errors="ignore")
+
+    def materialize_aggregates(self) -> dict:
+        return Aggregates.materialize_aggregates(self.datasets, self.aggregates_path)
+
+    def finalize(self, exact_stats=False) -> None:
+        '''
+        Everything that runs once all projects have been parsed.
+        '''
+        self.progress.stage("consolidating")
+        self.consolidate_datasets(exact=exact_stats)
+        self.materialize_aggregates()
+        self.rollups = Aggregates.compute_rollups(self.datasets)
+        self.save_cache()
+        self.payees.export_review(os.path.join(self.root, "payee_review.csv"))
+        self.clear_checkpoints()
+
+    def memory_report(self) -> pd.DataFrame:
+        return memory_report(self.datasets, self.peak_rss)
+
+    def checkpoint_file(self, project_name:str) -> str:
+        name = hashlib.md5(project_name.encode("utf-8")).hexdigest()
+        return os.path.join(self.checkpoints_path, "%s.pickle" % name)
+
+    def checkpoint_project(self, project_name:str, outputs:dict) -> None:
+        '''
+        Commits a finished project: its parsed outputs are written atomically, then its
+        manifest rows are flushed. An interrupted run therefore skips the project next
+        time and picks its outputs up from the checkpoint.
+
+        A shard only stages the rows, they are flushed by the merge once the outputs are in
+        df_caches. They are also kept in the checkpoint, so a shard that stops before the
+        merge picks them up again with restage_checkpoints and still skips the project.
+        '''
+        paths = [entry.path_display for entry in self.dbx_files[project_name]]
+        path = self.checkpoint_file(project_name)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump((project_name, outputs, self.manifest.staged(paths)), f)
+        os.replace(path + ".tmp", path)
+
+        if not self.shard:
+            self.manifest.flush(paths)
+        self.payees.flush()
+
+    def drop_checkpoints(self, project_names) -> None:
+        for project_name in project_names:
+            path = self.checkpoint_file(project_name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load_checkpoints(self) -> None:
+        for file in os.listdir(self.checkpoints_path):
+            if file.endswith(".pickle"):
+                with open(os.path.join(self.checkpoints_path, file), "rb") as f:
+                    _, outputs = pickle.load(f)[:2]
+                for _type, dfs in outputs.items():
+                    self.datasets[_type] += dfs
+
+    def restage_checkpoints(self) -> None:
+        '''
+        Stages the manifest rows of the projects a shard checkpointed in a run that never
+        reached the merge, so they count as unchanged and go out with this run's partial.
+        '''
+        for file in os.listdir(self.checkpoints_path):
+            if file.endswith(".pickle"):
+                with open(os.path.join(self.checkpoints_path, file), "rb") as f:
+                    checkpoint = pickle.load(f)
+                rows = checkpoint[2] if len(checkpoint) > 2 else {}
+                self.manifest.stage_many(rows)
+                self.resumed.update(rows)
+
+    def clear_checkpoints(self) -> None:
+        # outside of a shard this includes the shards' checkpoints, which the merge consolidated
+        dirs = [self.checkpoints_path]
+        if not self.shard:
+            dirs += [path for path in glob.glob(os.path.join(self.checkpoints_path, "shard_*")) if os.path.isdir(path)]
+
+        for path in dirs:
+            for file in os.listdir(path):
+                if file.endswith(".pickle") or file.endswith(".tmp"):
+                    os.remove(os.path.join(path, file))
     
-    def create_datasets(self) -> None:
+    def dump_partial(self, out_dir:str) -> str:
+        '''
+        Writes the unconsolidated datasets, the staged manifest rows and the file timings of
+        a sharded run to out_dir so they can be merged by load_partial on another process / node.
+        '''
+        os.makedirs(out_dir, exist_ok=True)
+
+        for _type, dfs in self.datasets.items():
+            with open(os.path.join(out_dir, "%s.pickle" % _type), "wb") as f:
+                pickle.dump(dfs, f)
+        
+        with open(os.path.join(out_dir, "manifest.pickle"), "wb") as f:
+            pickle.dump(self.manifest.pending, f)
+
+        with open(os.path.join(out_dir, "timings.pickle"), "wb") as f:
+            pickle.dump(self.file_timings, f)
+
+        return out_dir
+
+    def load_partial(self, out_dir:str) -> None:
+        for _type in self.datasets:
+            path = os.path.join(out_dir, "%s.pickle" % _type)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    self.datasets[_type] += pickle.load(f)
+
+        path = os.path.join(out_dir, "manifest.pickle")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.manifest.stage_many(pickle.load(f))
+
+        path = os.path.join(out_dir, "timings.pickle")
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.file_timings += pickle.load(f)
+
+    def create_datasets(self, consolidate=True, exact_stats=False) -> None:
+        '''
+        Stops with RunCancelled soon after the cancel token is set. In-flight parses finish,
+        unstarted work is abandoned, and finished projects stay in the checkpoints for the
+        next run to reuse.
+        '''
+        self.progress.stage("listing")
+        if self.shard:
+            self.restage_checkpoints()
         self.create_files()
+        self.share_blobs()
+        self.open_scratch()
+        projects = list(self.dbx_files.keys())
+        self.drop_checkpoints(projects) # changed again since they were checkpointed
+        self.progress.stage("classifying", projects_total=len(projects))
+        indexes, choices = self.index_projects(projects) # FileIndexes of lazily downloaded FileRecords
+        self.progress.stage("processing", projects_total=len(projects))
 
         def process_project(dir):
+            self.cancel_token.raise_if_cancelled()
             project_name = dir
-            entries = self.dbx_files[dir]
-            
-            files = self.get_files_from_project(entries) # pd.DataFrame of fileobjs and their descriptors
-
-            for _type in self.datasets:
-                file = self.select_best_file(_type, files)
-                if file:
-                    _df = self.file_to_df(**file)
-                    _df["PROJECT NAME"] = project_name
-                    self.datasets[_type].append(_df)
-
-                    if _type == "CS":
-                        date_str = "20%s-01-01" % project_name[:2]
-                        _df.DATE = _df.DATE.replace("REPLACE", date_str)
-
-                        csss = get_CS_section_dfs(_df, file["file_obj"], file["extension"])
-                        csss["PROJECT NAME"] = project_name
-                        self.datasets["CSSS"].append(csss)
-
-        if len(self.dbx_files.keys()) > self.chunk_size:
-            projects = list(self.dbx_files.keys())
-            chunks = list(range(0, len(projects), 50)) + [len(projects)]
-            for idx, chunk in enumerate(chunks[1:]):
-                start = chunks[idx]
-                stop = chunk
-
-                with ThreadPoolExecutor() as executor:
-                    # Submit file processing tasks to the executor
-                    futures = [executor.submit(process_project, dir) for dir in projects[start:stop]]
-                    # Wait for all tasks to complete
-                    wait(futures)
-                
-                self.cache_current_chunk()
-            
-            self.datasets = self.load_chunked_dfs()
-            self.clear_chunks_cache()
-        else:
+            outputs = {_type: [] for _type in self.datasets}
+            files = indexes[dir]
+            chosen = choices[dir]
+
+            try:
+                for _type, file in chosen.items():
+                    self.cancel_token.raise_if_cancelled()
+                    if file:
+                        _df = self.parse_file(file)
+                        _df["PROJECT NAME"] = project_name
+
+                        if _type == "CS":
+                            date_str = "20%s-01-01" % project_name[:2]
+                            _df.DATE = _df.DATE.replace("REPLACE", date_str)
+
+                            csss = self.parse_sections(_df, file)
+                            csss["PROJECT NAME"] = project_name
+                            outputs["CSSS"].append(enforce_schema(csss, "CSSS"))
+
+                        outputs[_type].append(enforce_schema(_df, _type))
+            except RunCancelled:
+                raise # abandoned, the next run processes it again
+            except Exception as e:
+                self.checkpoint_project(project_name, outputs)
+                self.progress.error("%s: %r" % (project_name, e))
+                self.progress.project_done()
+                raise
+            else:
+                self.checkpoint_project(project_name, outputs)
+                self.progress.project_done()
+            finally:
+                self.release_files([file for file in chosen.values() if file])
+                for record in files:
+                    self.trace_log.write(record.trace)
+
+        budget = MemoryBudget(self.memory_budget, on_pressure=self.spill)
+        try:
+            # outputs live in the checkpoints, so memory is only held for the projects admitted by the budget
             with ThreadPoolExecutor() as executor:
-                futures = [executor.submit(process_project, dir) for dir in projects]
-                wait(futures)
+                for dir in projects:
+                    cost = estimate_project_cost(self.dbx_files[dir])
+                    budget.acquire(cost, self.cancel_token)
+                    future = executor.submit(process_project, dir)
+                    future.add_done_callback(lambda _, cost=cost: budget.release(cost))
+        finally:
+            self.downloads.clear()
+            self.parses.clear()
+            self.close_scratch()
+            self.peak_rss = max(self.peak_rss, budget.peak_rss)
+            self.progress.memory(budget.peak_rss, budget.budget, budget.spills)
+
+        self.cancel_token.raise_if_cancelled()
+
+        # includes projects finished by an earlier run that was interrupted before consolidating
+        self.clear_datasets()
+        self.load_checkpoints()
 
-        self.consolidate_datasets()
-        self.save_cache()
\ No newline at end of file
+        if consolidate: # sharded workers leave this to the merge step
+            self.finalize(exact_stats)
\ No newline at end of file
@@ -0,0 +1,150 @@
+from openpyxl.worksheet._write_only import WriteOnlyCell
+from openpyxl.worksheet.table import Table, TableColumn, TableStyleInfo
+from openpyxl.worksheet.filters import AutoFilter
+from modules.DBXReader import DbxDataRetriever, enforce_schema
+from openpyxl.utils import get_column_letter
+from modules import CONSTANTS, Aggregates
+from openpyxl import Workbook
+import pandas as pd
+import warnings
+import glob
+import uuid
+import os
+
+
+EXPORTS_PATH = "exports"
+EXPORT_SHEETS = ["CS", "CSSS", "PR", "PO"]
+
+# number format and column width per schema dtype, other columns are text
+COLUMN_FORMATS = {
+    "float64" : ("#,##0.00", 14),
+    "float32" : ("0.00", 12),
+    "datetime64[ns]" : ("yyyy-mm-dd", 12),
+}
+TEXT_WIDTH = 24
+
+
+def export_path(root:str, version:str) -> str:
+    return os.path.join(root, EXPORTS_PATH, "datasets_%s.xlsx" % version)
+
+def dataset_version(root="") -> str:
+    # the aggregates are materialized from the same consolidation, so they share its version
+    return Aggregates.aggregates_version(os.path.join(root, Aggregates.AGGREGATES_PATH))
+
+def iter_chunks(csv_path:str, _type:str, chunksize:int):
+    if not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0:
+        return
+    try:
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+            yield enforce_schema(chunk.drop(columns=[CONSTANTS.RAW_VARIANCE_COL], errors="ignore"), _type)
+    except pd.errors.EmptyDataError:
+        return
+
+def cell_writer(ws, dtype):
+    '''
+    Returns a function turning a value of the column into a cell: typed, NaN / NaT as empty,
+    and with the column's number format.
+    '''
+    if dtype in COLUMN_FORMATS:
+        number_format = COLUMN_FORMATS[dtype][0]
+        if dtype.startswith("datetime"):
+            convert = lambda value: value.to_pydatetime()
+        elif dtype == "float32":
+            convert = lambda value: round(float(value), 6) # without float32's representation noise
+        else:
+            convert = float
+
+        def write(value):
+            if pd.isna(value):
+                return None
+            cell = WriteOnlyCell(ws, convert(value))
+            cell.number_format = number_format
+            return cell
+        return write
+
+    return lambda value: None if pd.isna(value) else str(value)
+
+def write_sheet(wb:Workbook, _type:str, csv_path:str, chunksize:int) -> int:
+    '''
+    Streams one dataset from its cached csv into a sheet, chunksize rows in memory at a
+    time, and covers it with a table once the row count is known. Returns the row count.
+    '''
+    ws = wb.create_sheet(_type)
+    schema = CONSTANTS.DATASET_SCHEMAS.get(_type, {})
+    columns, writers, rows = None, None, 0
+
+    for chunk in iter_chunks(csv_path, _type, chunksize):
+        if columns is None: # widths, freeze panes and the header go before the first row
+            columns = list(chunk.columns)
+            dtypes = [schema.get(col, "object") for col in columns]
+            writers = [cell_writer(ws, dtype) for dtype in dtypes]
+            for i, dtype in enumerate(dtypes, start=1):
+                ws.column_dimensions[get_column_letter(i)].width = COLUMN_FORMATS.get(dtype, (None, TEXT_WIDTH))[1]
+            ws.freeze_panes = "A2"
+            ws.append(columns)
+
+        for values in chunk.itertuples(index=False, name=None):
+            ws.append([write(value) for write, value in zip(writers, values)])
+        rows += len(chunk)
+
+    if rows:
+        ref = "A1:%s%d" % (get_column_letter(len(columns)), rows + 1)
+        table = Table(displayName="tbl_%s" % _type, ref=ref, autoFilter=AutoFilter(ref=ref))
+        table.tableColumns = [TableColumn(id=i, name=col) for i, col in enumerate(columns, start=1)] # not inferred in write-only mode
+        table.tableStyleInfo = TableStyleInfo(name="TableStyleMedium2", showRowStripes=True)
+        with warnings.catch_warnings(): # openpyxl warns on every write-only table, the columns are set above
+            warnings.simplefilter("ignore")
+            ws.add_table(table)
+
+    return rows
+
+def export_datasets(df_caches_path:str, out_path:str, chunksize=CONSTANTS.EXPORT_CHUNK_ROWS) -> dict:
+    '''
+    Writes CS, CSSS, PR and PO from the cached full history into one xlsx with openpyxl's
+    write-only workbook, which streams rows to disk instead of building the workbook in
+    memory. The file appears at out_path only once complete. Returns the row counts.
+    '''
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    wb = Workbook(write_only=True)
+    counts = {
+        _type: write_sheet(wb, _type, os.path.join(df_caches_path, "%s.csv" % _type), chunksize)
+        for _type in EXPORT_SHEETS
+    }
+
+    tmp_path = "%s.%s.tmp" % (out_path, uuid.uuid4().hex)
+    wb.save(tmp_path)
+    os.replace(tmp_path, out_path)
+
+    return counts
+
+def cached_export(root="", version=None):
+    '''
+    The export of the datasets' current version, None until the run that consolidated
+    them has built it.
+    '''
+    version = version or dataset_version(root)
+    if version is None:
+        return None
+
+    path = export_path(root, version)
+    return path if os.path.exists(path) else None
+
+def build_export(root="") -> str:
+    '''
+    Builds the export of the datasets' current version, at the end of the processing run
+    that consolidated them, and only then removes the exports of older versions. None
+    before any run has consolidated the datasets.
+    '''
+    version = dataset_version(root)
+    if version is None:
+        return None
+
+    path = export_path(root, version)
+    if not os.path.exists(path):
+        export_datasets(os.path.join(root, DbxDataRetriever.df_caches_path), path)
+
+    for old in glob.glob(os.path.join(root, EXPORTS_PATH, "datasets_*.xlsx")):
+        if old != path:
+            os.remove(old) # a download already streaming it keeps its open file
+
+    return path
@@ -0,0 +1,66 @@
+from modules import CONSTANTS
+
+
+class FileRecord:
+    '''
+    Light handle on one file in a project folder. The payload (the downloaded
+    file) is only fetched through the loader when file_obj is first accessed.
+    '''
+    __slots__ = ("path", "_type", "extension", "size", "content_hash", "_loader", "_payload", "trace")
+
+    def __init__(self, path:str, extension:str, size:int, content_hash:str, loader, _type=None, trace=None) -> None:
+        self.path = path
+        self._type = _type
+        self.extension = extension
+        self.size = size
+        self.content_hash = content_hash
+        self._loader = loader
+        self._payload = None
+        self.trace = trace # Trace.FileTrace
+
+    @property
+    def file_obj(self):
+        if self._payload is None:
+            self._payload = self._loader()
+        return self._payload
+
+    @property
+    def loaded(self) -> bool:
+        return self._payload is not None
+
+    def release(self) -> None:
+        self._payload = None
+
+    def __repr__(self) -> str:
+        return "FileRecord(%r, %r)" % (self.path, self._type)
+
+
+class FileIndex:
+    '''
+    A project's files keyed by (type, extension), so picking the best file is a dict lookup.
+    '''
+    __slots__ = ("records", "by_key")
+
+    def __init__(self, records=()) -> None:
+        self.records = []
+        self.by_key = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record:FileRecord) -> None:
+        self.records.append(record)
+        self.by_key.setdefault((record._type, record.extension), []).append(record)
+
+    def best(self, _type:str):
+        for extension in CONSTANTS.FILE_PREFERENCE:
+            matches = self.by_key.get((_type, extension))
+            if matches:
+                return matches[0]
+
+        return None
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self) -> int:
+        return len(self.records)
@@ -0,0 +1,169 @@
+import pandas as pd
+import threading
+import sqlite3
+import time
+
+
+def connect(path:str, attempts=50) -> sqlite3.Connection:
+    '''
+    Opens a WAL-mode SQLite database shared between threads and processes. Switching the
+    journal mode doesn't wait on the busy timeout, so processes opening the same new
+    database at once retry it.
+    '''
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    for attempt in range(attempts):
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            return conn
+        except sqlite3.OperationalError as e:
+            if not "locked" in str(e) or attempt == attempts - 1:
+                raise
+            time.sleep(0.1)
+
+
+def row_matches(row:dict, metadata) -> bool:
+    # the content hash when both sides have one, the modification time otherwise
+    if metadata.content_hash and row.get("content_hash"):
+        return row["content_hash"] == metadata.content_hash
+
+    return row.get("client_modified") == str(metadata.client_modified)
+
+
+class FileManifest:
+    '''
+    SQLite (WAL) manifest of every file seen in the Dropbox folder, keyed by full path.
+    Updates are staged in memory from any thread and written in one batched
+    transaction by flush().
+    '''
+    path = "dbx_manifest.sqlite"
+    columns = [
+        "path", "project", "name", "content_hash", "rev", "size", "client_modified",
+        "type", "parse_status", "download_s", "parse_s", "updated_at"
+    ]
+
+    def __init__(self, path=None) -> None:
+        self.path = path or self.path
+        self.lock = threading.Lock()
+        self.pending = {} # path -> {column: value}
+
+        self.conn = connect(self.path)
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    project TEXT,
+                    name TEXT,
+                    content_hash TEXT,
+                    rev TEXT,
+                    size INTEGER,
+                    client_modified TEXT,
+                    type TEXT,
+                    parse_status TEXT,
+                    download_s REAL,
+                    parse_s REAL,
+                    updated_at REAL
+                )
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS classifications (
+                    content_hash TEXT PRIMARY KEY,
+                    type TEXT,
+                    classified_at REAL
+                )
+            ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_project ON files (project)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS files_content_hash ON files (content_hash)")
+
+    def get(self, path:str):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM files WHERE path = ?", (path,)).fetchone()
+
+        return dict(zip(self.columns, row)) if row else None
+
+    def is_unchanged(self, metadata) -> bool:
+        row = self.get(metadata.path_display)
+        return bool(row) and row_matches(row, metadata)
+
+    def get_classification(self, content_hash:str):
+        with self.lock:
+            row = self.conn.execute("SELECT type FROM classifications WHERE content_hash = ?", (content_hash,)).fetchone()
+
+        return row[0] if row else None
+
+    def put_classification(self, content_hash:str, _type:str) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO classifications (content_hash, type, classified_at) VALUES (?, ?, ?)",
+                (content_hash, _type, time.time())
+            )
+
+    def stage(self, path:str, **fields) -> None:
+        fields["updated_at"] = time.time()
+        with self.lock:
+            self.pending.setdefault(path, {}).update(fields)
+
+    def stage_file(self, metadata, project:str) -> None:
+        self.stage(
+            metadata.path_display,
+            project=project,
+            name=metadata.name,
+            content_hash=metadata.content_hash,
+            rev=metadata.rev,
+            size=metadata.size,
+            client_modified=str(metadata.client_modified),
+            parse_status="pending",
+        )
+
+    def staged(self, paths) -> dict:
+        with self.lock:
+            return {path: dict(self.pending[path]) for path in paths if path in self.pending}
+
+    def stage_many(self, pending:dict) -> None:
+        for path, fields in pending.items():
+            with self.lock:
+                self.pending.setdefault(path, {}).update(fields)
+
+    def flush(self, paths=None) -> None:
+        '''
+        Writes the staged updates (or only those for paths) in a single transaction.
+        '''
+        with self.lock:
+            if paths is None:
+                rows, self.pending = self.pending, {}
+            else:
+                rows = {path: self.pending.pop(path) for path in paths if path in self.pending}
+
+            # rows are grouped by which columns they set so each group is one executemany
+            groups = {}
+            for path, fields in rows.items():
+                groups.setdefault(tuple(sorted(fields)), []).append((path, *[fields[col] for col in sorted(fields)]))
+
+            with self.conn:
+                for cols, values in groups.items():
+                    self.conn.executemany(
+                        "INSERT INTO files (path, %s) VALUES (?, %s) ON CONFLICT(path) DO UPDATE SET %s" % (
+                            ", ".join(cols),
+                            ", ".join("?" * len(cols)),
+                            ", ".join("%s = excluded.%s" % (col, col) for col in cols)
+                        ),
+                        values
+                    )
+
+    def clear(self) -> None:
+        with self.lock:
+            self.pending = {}
+            with self.conn:
+                self.conn.execute("DELETE FROM files")
+
+    def summary(self) -> pd.DataFrame:
+        with self.lock:
+            return pd.read_sql_query('''
+                SELECT type, parse_status, COUNT(*) AS files, SUM(size) AS bytes,
+                       SUM(download_s) AS download_s, SUM(parse_s) AS parse_s
+                FROM files GROUP BY type, parse_status ORDER BY files DESC
+            ''', self.conn)
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
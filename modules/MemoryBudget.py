@@ -0,0 +1,83 @@
+from modules import CONSTANTS
+import threading
+import psutil
+import os
+
+
+def default_budget() -> int:
+    mb = os.environ.get("MEMORY_BUDGET_MB")
+    if mb:
+        return int(float(mb) * 2**20)
+
+    return int(psutil.virtual_memory().total * CONSTANTS.MEMORY_BUDGET_FRACTION)
+
+def estimate_project_cost(entries) -> int:
+    '''
+    Rough peak memory of processing a project, from the Dropbox metadata sizes of the
+    files the readers could parse. Other files (video, images) are never loaded.
+    '''
+    parseable = sum(
+        entry.size for entry in entries
+        if os.path.splitext(entry.path_display)[1] in CONSTANTS.FILE_PREFERENCE
+    )
+
+    return int(parseable * CONSTANTS.PARSE_EXPANSION) + CONSTANTS.PROJECT_OVERHEAD_BYTES
+
+
+class MemoryBudget:
+    '''
+    Admits work while the process RSS plus the estimated cost of admitted work stays under
+    the high watermark. Going over it calls on_pressure (to spill what can be dropped) and
+    holds further admissions until the load is back under the low watermark. Work is always
+    admitted when nothing is in flight, so one project larger than the budget still runs.
+    '''
+    def __init__(self, budget_bytes=None, on_pressure=None, poll_s=0.25) -> None:
+        self.budget = budget_bytes or default_budget()
+        low, high = CONSTANTS.MEMORY_WATERMARKS
+        self.low = self.budget * low
+        self.high = self.budget * high
+        self.on_pressure = on_pressure
+        self.poll_s = poll_s
+
+        self.process = psutil.Process()
+        self.cond = threading.Condition()
+        self.reserved = 0
+        self.in_flight = 0
+        self.throttled = False
+        self.peak_rss = 0
+        self.spills = 0 # times the load went over the high watermark
+
+    def rss(self) -> int:
+        rss = self.process.memory_info().rss
+        self.peak_rss = max(self.peak_rss, rss)
+        return rss
+
+    def acquire(self, cost:int, cancel_token=None) -> None:
+        while True:
+            with self.cond:
+                load = self.rss() + self.reserved
+                if self.throttled and load <= self.low:
+                    self.throttled = False
+
+                if self.in_flight == 0 or (not self.throttled and load + cost <= self.high):
+                    self.reserved += cost
+                    self.in_flight += 1
+                    return
+
+                pressure = load > self.high and not self.throttled
+                if pressure:
+                    self.throttled = True
+                    self.spills += 1
+                else:
+                    self.cond.wait(self.poll_s)
+
+            if pressure and self.on_pressure:
+                self.on_pressure()
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+
+    def release(self, cost:int) -> None:
+        with self.cond:
+            self.reserved -= cost
+            self.in_flight -= 1
+            self.cond.notify_all()
@@ -0,0 +1,202 @@
+from modules.Manifest import connect
+from collections import Counter
+from modules import CONSTANTS
+import pandas as pd
+import threading
+import hashlib
+import time
+import re
+
+
+def normalize_payee(payee:str) -> str:
+    payee = payee.split("-")[0].lower()
+
+    for sub in CONSTANTS.subs:
+        payee = re.sub(sub[0], sub[1], payee)
+
+    return payee.strip()
+
+def categorize_payee(payee:str):
+    '''
+    The hand-written CONSTANTS.categories rules: a keyword in the payee or an exact
+    known member name. Returns the category or None.
+    '''
+    for keywords, members, category in CONSTANTS.categories:
+        if any(keyword in payee for keyword in keywords) or payee in members:
+            return category
+
+    return None
+
+def rules_version() -> str:
+    rules = (CONSTANTS.subs, CONSTANTS.categories, CONSTANTS.PAYEE_MATCH_THRESHOLD)
+    return hashlib.md5(repr(rules).encode("utf-8")).hexdigest()
+
+def match_key(name:str) -> str:
+    # "bob  smith" and "bob smith" are the same payee
+    return " ".join(name.split())
+
+def trigrams(string:str) -> set:
+    padded = "  %s " % string
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    '''
+    Inverted index of character trigrams, best() returns the indexed name with the
+    highest Jaccard similarity to a string while only scoring names that share a trigram.
+    '''
+    def __init__(self) -> None:
+        self.postings = {} # trigram -> set of names
+        self.grams = {} # name -> trigrams
+
+    def add(self, name:str) -> None:
+        if name in self.grams:
+            return
+
+        self.grams[name] = trigrams(name)
+        for gram in self.grams[name]:
+            self.postings.setdefault(gram, set()).add(name)
+
+    def best(self, string:str) -> tuple:
+        grams = trigrams(string)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+
+        best_name, best_score = None, 0.0
+        for name, count in shared.items():
+            score = count / (len(grams) + len(self.grams[name]) - count)
+            if score > best_score:
+                best_name, best_score = name, score
+
+        return best_name, best_score
+
+
+class PayeeStore:
+    '''
+    Persistent raw payee -> (canonical payee, category) dictionary that grows across runs.
+    Raw strings seen before are a dict lookup. New ones go through the CONSTANTS rules, then
+    a trigram match against the known names, and are only merged into a known payee when
+    they are near-identical (threshold). Anything less similar becomes its own payee, with
+    the closest known name kept as a candidate for review rather than merged. Everything is
+    re-resolved when the CONSTANTS rules or the threshold change.
+    '''
+    path = "payees.sqlite"
+    columns = ["raw", "canonical", "category", "method", "score", "matched", "updated_at"]
+
+    def __init__(self, path=None, threshold=CONSTANTS.PAYEE_MATCH_THRESHOLD, review_score=CONSTANTS.PAYEE_REVIEW_SCORE) -> None:
+        self.path = path or self.path
+        self.threshold = threshold
+        self.review_score = review_score
+        self.lock = threading.Lock()
+        self.pending = {} # raw -> row
+
+        self.conn = connect(self.path)
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS payees (
+                    raw TEXT PRIMARY KEY,
+                    canonical TEXT,
+                    category TEXT,
+                    method TEXT,
+                    score REAL,
+                    matched TEXT,
+                    updated_at REAL
+                )
+            ''')
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'rules_version'").fetchone()
+            if not row or row[0] != rules_version():
+                self.conn.execute("DELETE FROM payees")
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('rules_version', ?)", (rules_version(),))
+
+        self.load()
+
+    def load(self) -> None:
+        self.resolved = {} # raw -> canonical
+        self.known = {} # normalized name -> (canonical, category)
+        self.index = TrigramIndex()
+
+        for _, members, category in CONSTANTS.categories:
+            for member in members:
+                self.remember(member.lower(), category, category)
+
+        for raw, canonical, category, method in self.conn.execute("SELECT raw, canonical, category, method FROM payees"):
+            self.resolved[raw] = canonical
+            if method in ("new", "candidate"):
+                self.remember(match_key(normalize_payee(raw)), canonical, category)
+
+    def remember(self, name:str, canonical:str, category) -> None:
+        self.known[name] = (canonical, category)
+        self.index.add(name)
+
+    def match(self, raw:str) -> dict:
+        name = normalize_payee(raw)
+
+        category = categorize_payee(name)
+        if category:
+            return {"canonical": category, "category": category, "method": "rule", "score": 1.0, "matched": None}
+
+        name = match_key(name)
+        if name in self.known:
+            canonical, category = self.known[name]
+            return {"canonical": canonical, "category": category, "method": "exact", "score": 1.0, "matched": name}
+
+        matched, score = self.index.best(name)
+        if matched and score >= self.threshold:
+            canonical, category = self.known[matched]
+            return {"canonical": canonical, "category": category, "method": "fuzzy", "score": score, "matched": matched}
+
+        canonical = name.title()
+        self.remember(name, canonical, None)
+        method = "candidate" if matched and score >= self.review_score else "new"
+        return {"canonical": canonical, "category": None, "method": method, "score": score, "matched": matched}
+
+    def resolve(self, raw:str) -> str:
+        with self.lock:
+            canonical = self.resolved.get(raw)
+            if canonical is None:
+                row = self.match(raw)
+                row["updated_at"] = time.time()
+                self.pending[raw] = row
+                canonical = self.resolved[raw] = row["canonical"]
+
+        return canonical
+
+    def resolve_many(self, payees:pd.Series) -> pd.Series:
+        # payee logs repeat the same few vendors, so each distinct string is resolved once,
+        # in sorted order so which of two similar names becomes canonical doesn't depend on row order
+        return payees.map({raw: self.resolve(raw) for raw in sorted(payees.unique(), key=str)})
+
+    def flush(self) -> None:
+        with self.lock:
+            rows, self.pending = self.pending, {}
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO payees VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(raw, *[row[col] for col in self.columns[1:]]) for raw, row in rows.items()]
+                )
+
+    def review(self) -> pd.DataFrame:
+        '''
+        Payees kept separate from a similar known payee (matched), most similar first.
+        '''
+        with self.lock:
+            return pd.read_sql_query("SELECT * FROM payees WHERE method = 'candidate' ORDER BY score DESC", self.conn)
+
+    def export_review(self, path="payee_review.csv") -> pd.DataFrame:
+        review = self.review()
+        review.to_csv(path, index=False)
+        return review
+
+    def clear(self) -> None:
+        with self.lock:
+            self.pending = {}
+            with self.conn:
+                self.conn.execute("DELETE FROM payees")
+            self.load()
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+from collections import Counter
+import threading
+import cProfile
+import json
+import time
+import sys
+import os
+
+
+PROFILES_PATH = "profiles"
+
+
+class StackSampler(threading.Thread):
+    '''
+    Samples the stack of every thread at a fixed interval and counts them as collapsed
+    stacks ("outer;inner;leaf count"), the input format of flamegraph.pl and speedscope.
+    cProfile only sees the thread it was enabled on, and the pipeline does most of its
+    work on executor threads, so this is what shows where those threads spend time.
+    '''
+    def __init__(self, interval=0.01) -> None:
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.counts = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.ident:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                self.counts[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+    def write(self, path:str) -> None:
+        with open(path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write("%s %d\n" % (stack, count))
+
+
+@contextmanager
+def profile_run(path=PROFILES_PATH, name="run", run_dir=None):
+    '''
+    Profiles the enclosed block and writes <name>.pstats (cProfile, calling thread)
+    and <name>.collapsed (sampled, all threads) to a new directory under path, or to
+    run_dir when given, e.g. a shard process adding its profile to its run's.
+    Yields that directory so callers can add their own artifacts.
+    '''
+    run_dir = run_dir or os.path.join(path, time.strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(run_dir, exist_ok=True)
+
+    profiler = cProfile.Profile()
+    sampler = StackSampler()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield run_dir
+    finally:
+        profiler.disable()
+        sampler.stop()
+        profiler.dump_stats(os.path.join(run_dir, "%s.pstats" % name))
+        sampler.write(os.path.join(run_dir, "%s.collapsed" % name))
+
+def write_slowest_files(file_timings:list, run_dir:str, top_n=20) -> list:
+    slowest = sorted(file_timings, key=lambda timing: timing["seconds"], reverse=True)[:top_n]
+    with open(os.path.join(run_dir, "slowest_files.json"), "w") as f:
+        json.dump(slowest, f, indent=2)
+
+    return slowest
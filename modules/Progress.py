@@ -0,0 +1,125 @@
+import threading
+import glob
+import json
+import time
+import os
+
+
+PROGRESS_FILE = "progress.json"
+
+
+def progress_path(root="", shard=None) -> str:
+    if shard is None:
+        return os.path.join(root, PROGRESS_FILE)
+    return os.path.join(root, "progress_shard_%d.json" % shard)
+
+def write_json(path:str, data:dict) -> None:
+    # readers only ever see a complete file
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def clear_progress(root="") -> None:
+    for path in glob.glob(os.path.join(root, "progress*.json")):
+        os.remove(path)
+
+def read_progress(root=""):
+    '''
+    The run's progress, with the shard workers' files of a sharded run summed in.
+    None before anything has been reported.
+    '''
+    reports = []
+    for path in [progress_path(root)] + sorted(glob.glob(os.path.join(root, "progress_shard_*.json"))):
+        try:
+            with open(path) as f:
+                reports.append(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            continue
+
+    if not reports:
+        return None
+
+    progress = dict(reports[0])
+    for report in reports[1:]:
+        for key in ("projects_done", "projects_total", "files_parsed"):
+            progress[key] = progress.get(key, 0) + report.get(key, 0)
+        progress["errors"] = progress.get("errors", []) + report.get("errors", [])
+        for key in ("peak_rss_mb", "memory_budget_mb"): # per process, the largest is what matters
+            if key in report:
+                progress[key] = max(progress.get(key, 0), report[key])
+        if "memory_spills" in report:
+            progress["memory_spills"] = progress.get("memory_spills", 0) + report["memory_spills"]
+        etas = [eta for eta in (progress.get("eta_s"), report.get("eta_s")) if eta is not None]
+        progress["eta_s"] = max(etas, default=None)
+        progress["updated_at"] = max(progress.get("updated_at", 0), report.get("updated_at", 0))
+
+    return progress
+
+
+class ProgressReporter:
+    '''
+    Progress of a processing run, written atomically to a JSON file the web process
+    streams from. Counters can be bumped from any thread, writes are throttled to one
+    every min_interval_s except for stage changes.
+    '''
+    max_errors = 20
+
+    def __init__(self, path=None, min_interval_s=0.5) -> None:
+        self.path = path
+        self.min_interval_s = min_interval_s
+        self.lock = threading.Lock()
+        self.last_write = 0
+        self.processing_started = None
+        self.state = {
+            "stage": "starting",
+            "projects_done": 0,
+            "projects_total": 0,
+            "files_parsed": 0,
+            "errors": [],
+            "eta_s": None,
+            "started_at": time.time(),
+            "updated_at": time.time(),
+        }
+
+    def stage(self, stage:str, **fields) -> None:
+        with self.lock:
+            self.state["stage"] = stage
+            self.state.update(fields)
+            if stage == "processing":
+                self.processing_started = time.time()
+            self.write(force=True)
+
+    def project_done(self) -> None:
+        with self.lock:
+            self.state["projects_done"] += 1
+            done, total = self.state["projects_done"], self.state["projects_total"]
+            if self.processing_started and total:
+                elapsed = time.time() - self.processing_started
+                self.state["eta_s"] = round(elapsed / done * (total - done), 1)
+            self.write()
+
+    def file_parsed(self) -> None:
+        with self.lock:
+            self.state["files_parsed"] += 1
+            self.write()
+
+    def memory(self, peak_rss:int, budget:int, spills:int) -> None:
+        with self.lock:
+            self.state["peak_rss_mb"] = round(peak_rss / 2**20)
+            self.state["memory_budget_mb"] = round(budget / 2**20)
+            self.state["memory_spills"] = spills
+            self.write(force=True)
+
+    def error(self, message:str) -> None:
+        with self.lock:
+            self.state["errors"] = (self.state["errors"] + [message])[-self.max_errors:]
+            self.write(force=True)
+
+    def write(self, force=False) -> None:
+        now = time.time()
+        if not self.path or (not force and now - self.last_write < self.min_interval_s):
+            return
+
+        self.state["updated_at"] = now
+        self.last_write = now
+        write_json(self.path, self.state)
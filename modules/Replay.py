@@ -0,0 +1,408 @@
+from modules.PayeeStore import PayeeStore
+from modules.Manifest import FileManifest
+from modules.Sketches import SectionStats
+from modules import Storage, Aggregates
+from contextlib import closing
+from datetime import datetime
+import argparse
+import sqlite3
+import dropbox
+import gspread
+import hashlib
+import shutil
+import json
+import time
+import io
+import os
+
+
+# A bundle is a directory:
+#   dropbox/listings/<md5 of path>.json   one files_list_folder result
+#   dropbox/downloads/<md5 of path>.json  which blob a path downloads to, and how long it took
+#   dropbox/blobs/<content hash>          file bytes, shared by identical files
+#   s3/<bucket>/<key>                     object bodies
+#   gspread/calls_<pid>.jsonl             every gspread call with a summary of its arguments
+#   cache/                                the tenant's manifest, classifications and caches as the run found them
+# RECORD_BUNDLE=<dir> records a run into a bundle, REPLAY_BUNDLE=<dir> replays one offline.
+# REPLAY_LATENCY is seconds added per call, or "recorded" (the default) to sleep as long as
+# the recorded call took. Replayed sheet uploads are written to REPLAY_OUT (default bundle/replay_out).
+# Bundles hold the recorded OAuth tokens and client secrets, keep them as private as those.
+
+def replay_out() -> str:
+    return os.environ.get("REPLAY_OUT") or os.path.join(os.environ["REPLAY_BUNDLE"], "replay_out")
+
+def cache_paths() -> list:
+    # what a run reads from the tenant's cache namespace to decide which files it still has to download
+    from modules.DBXReader import DbxDataRetriever # pulls in the readers
+    return [
+        FileManifest.path, PayeeStore.path, SectionStats.path, Aggregates.AGGREGATES_PATH,
+        DbxDataRetriever.df_caches_path, DbxDataRetriever.checkpoints_path,
+    ]
+
+def copy_caches(src_root:str, dst_root:str) -> None:
+    os.makedirs(dst_root or ".", exist_ok=True)
+    for name in cache_paths():
+        src, dst = os.path.join(src_root, name), os.path.join(dst_root, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, dst, dirs_exist_ok=True)
+        elif name.endswith(".sqlite") and os.path.exists(src):
+            # the backup API gives a consistent copy of a WAL database that is open elsewhere
+            with closing(sqlite3.connect(src)) as src_conn, closing(sqlite3.connect(dst)) as dst_conn:
+                src_conn.backup(dst_conn)
+        elif os.path.exists(src):
+            shutil.copyfile(src, dst)
+
+def snapshot_caches(root:str, bundle:str) -> None:
+    '''
+    Saves the tenant's caches into the bundle before a recorded run. Files they mark as
+    unchanged or already classified are never downloaded, so a replay needs them too.
+    '''
+    path = os.path.join(bundle, "cache")
+    shutil.rmtree(path, ignore_errors=True)
+    copy_caches(root, path)
+
+def replay_root(root:str) -> str:
+    '''
+    Fresh cache namespace for a replay, seeded with the caches the recording started from,
+    so every replay of a bundle downloads exactly what the recorded run did.
+    '''
+    path = os.path.join(replay_out(), "cache", root)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    snapshot = os.path.join(os.environ["REPLAY_BUNDLE"], "cache")
+    if os.path.isdir(snapshot):
+        copy_caches(snapshot, path)
+    return path
+
+def path_key(path:str) -> str:
+    return hashlib.md5(path.encode("utf-8")).hexdigest()
+
+def write_bytes(path:str, data:bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+def write_json(path:str, data) -> None:
+    write_bytes(path, json.dumps(data, default=str).encode("utf-8"))
+
+def read_json(path:str):
+    with open(path) as f:
+        return json.load(f)
+
+def entry_to_dict(entry) -> dict:
+    if isinstance(entry, dropbox.files.FileMetadata):
+        return {
+            "tag": "file", "name": entry.name, "id": entry.id, "path_lower": entry.path_lower,
+            "path_display": entry.path_display, "rev": entry.rev, "size": entry.size,
+            "content_hash": entry.content_hash, "client_modified": entry.client_modified.isoformat(),
+            "server_modified": entry.server_modified.isoformat(),
+        }
+    return {"tag": "folder", "name": entry.name, "id": entry.id, "path_lower": entry.path_lower, "path_display": entry.path_display}
+
+def dict_to_entry(data:dict):
+    fields = {key: val for key, val in data.items() if key != "tag"}
+    if data["tag"] == "file":
+        fields["client_modified"] = datetime.fromisoformat(fields["client_modified"])
+        fields["server_modified"] = datetime.fromisoformat(fields["server_modified"])
+        return dropbox.files.FileMetadata(**fields)
+    return dropbox.files.FolderMetadata(**fields)
+
+def summarize(value):
+    # sheet values are only recorded by shape
+    if isinstance(value, list):
+        return {"rows": len(value), "cols": len(value[0]) if value and isinstance(value[0], list) else None}
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return type(value).__name__
+
+
+class Latency:
+    def __init__(self, setting=None) -> None:
+        setting = setting if setting is not None else os.environ.get("REPLAY_LATENCY", "recorded")
+        self.fixed = None if setting == "recorded" else float(setting)
+
+    def sleep(self, recorded_s=0.0) -> None:
+        seconds = self.fixed if self.fixed is not None else recorded_s or 0.0
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+# DROPBOX ————————————————————————————————————————————————————————————————————————————————————————————————————————
+class RecordingDropbox:
+    '''
+    Passes calls through to a real dropbox.Dropbox and saves the responses to the bundle.
+    '''
+    def __init__(self, dbx, bundle:str) -> None:
+        self.dbx = dbx
+        self.bundle = bundle
+
+    def files_list_folder(self, path, *args, **kwargs):
+        # pages are recorded (and returned) as one listing
+        start = time.perf_counter()
+        res = self.dbx.files_list_folder(path, *args, **kwargs)
+        entries = list(res.entries)
+        while res.has_more:
+            res = self.dbx.files_list_folder_continue(res.cursor)
+            entries += res.entries
+        entries = [entry for entry in entries if isinstance(entry, (dropbox.files.FileMetadata, dropbox.files.FolderMetadata))]
+
+        write_json(os.path.join(self.bundle, "dropbox", "listings", "%s.json" % path_key(path)), {
+            "path": path,
+            "s": time.perf_counter() - start,
+            "entries": [entry_to_dict(entry) for entry in entries],
+        })
+        return dropbox.files.ListFolderResult(entries=entries, cursor=res.cursor, has_more=False)
+
+    def files_download_to_file(self, download_path, path, *args, **kwargs):
+        start = time.perf_counter()
+        metadata = self.dbx.files_download_to_file(download_path, path, *args, **kwargs)
+        seconds = time.perf_counter() - start
+
+        key = metadata.content_hash or path_key(path)
+        blob = os.path.join(self.bundle, "dropbox", "blobs", key)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            shutil.copyfile(download_path, blob)
+        write_json(os.path.join(self.bundle, "dropbox", "downloads", "%s.json" % path_key(path)), {
+            "path": path, "blob": key, "s": seconds, "metadata": entry_to_dict(metadata),
+        })
+        return metadata
+
+    def __getattr__(self, name):
+        return getattr(self.dbx, name)
+
+
+class ReplayDropbox:
+    '''
+    Answers the Dropbox calls the pipeline makes from a bundle, without any network access.
+    '''
+    def __init__(self, bundle:str, latency=None) -> None:
+        self.bundle = bundle
+        self.latency = latency or Latency()
+
+    def files_list_folder(self, path, *args, **kwargs):
+        listing = read_json(os.path.join(self.bundle, "dropbox", "listings", "%s.json" % path_key(path)))
+        self.latency.sleep(listing["s"])
+        return dropbox.files.ListFolderResult(
+            entries=[dict_to_entry(entry) for entry in listing["entries"]], cursor="replay", has_more=False
+        )
+
+    def files_download_to_file(self, download_path, path, *args, **kwargs):
+        download = read_json(os.path.join(self.bundle, "dropbox", "downloads", "%s.json" % path_key(path)))
+        self.latency.sleep(download["s"])
+        shutil.copyfile(os.path.join(self.bundle, "dropbox", "blobs", download["blob"]), download_path)
+        return dict_to_entry(download["metadata"])
+
+
+def dropbox_client(access_token:str):
+    '''
+    The Dropbox client a run should use: a real (pooled) one, a recording one or a replaying one.
+    DbxDataRetriever wraps it in a Storage.DropboxBackend.
+    '''
+    if os.environ.get("REPLAY_BUNDLE"):
+        return ReplayDropbox(os.environ["REPLAY_BUNDLE"])
+
+    dbx = Storage.dropbox_client(access_token)
+    if os.environ.get("RECORD_BUNDLE"):
+        return RecordingDropbox(dbx, os.environ["RECORD_BUNDLE"])
+    return dbx
+
+
+# S3 ————————————————————————————————————————————————————————————————————————————————————————————————————————
+class RecordingS3:
+    def __init__(self, client, bundle:str) -> None:
+        self.client = client
+        self.bundle = bundle
+
+    def get_object(self, Bucket, Key, **kwargs):
+        obj = self.client.get_object(Bucket=Bucket, Key=Key, **kwargs)
+        body = obj["Body"].read()
+        write_bytes(os.path.join(self.bundle, "s3", Bucket, Key), body)
+        return {**obj, "Body": io.BytesIO(body)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        write_bytes(os.path.join(self.bundle, "s3", Bucket, Key), Body.encode("utf-8") if isinstance(Body, str) else Body)
+        return self.client.put_object(Bucket=Bucket, Key=Key, Body=Body, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class ReplayS3:
+    '''
+    Reads objects from the bundle. Writes are kept in memory so every replay starts
+    from the same recorded state.
+    '''
+    class NoSuchKey(Exception):
+        pass
+
+    def __init__(self, bundle:str) -> None:
+        self.bundle = bundle
+        self.written = {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) in self.written:
+            return {"Body": io.BytesIO(self.written[(Bucket, Key)])}
+
+        path = os.path.join(self.bundle, "s3", Bucket, Key)
+        if not os.path.exists(path):
+            raise self.NoSuchKey("%s/%s" % (Bucket, Key))
+        with open(path, "rb") as f:
+            return {"Body": io.BytesIO(f.read())}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.written[(Bucket, Key)] = Body.encode("utf-8") if isinstance(Body, str) else Body
+        return {}
+
+
+def s3_client(client_factory):
+    if os.environ.get("REPLAY_BUNDLE"):
+        return ReplayS3(os.environ["REPLAY_BUNDLE"])
+
+    client = client_factory()
+    if os.environ.get("RECORD_BUNDLE"):
+        return RecordingS3(client, os.environ["RECORD_BUNDLE"])
+    return client
+
+
+# GSPREAD ————————————————————————————————————————————————————————————————————————————————————————————————————————
+class RecordingProxy:
+    '''
+    Wraps a gspread client and the spreadsheets / worksheets it returns, logging every
+    call with its duration and a summary of its arguments.
+    '''
+    def __init__(self, obj, bundle:str, name:str) -> None:
+        self.obj = obj
+        self.bundle = bundle
+        self.name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self.obj, attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            result = value(*args, **kwargs)
+            with open(os.path.join(self.bundle, "gspread", "calls_%d.jsonl" % os.getpid()), "a") as f:
+                f.write(json.dumps({
+                    "call": "%s.%s" % (self.name, attr),
+                    "args": [summarize(arg) for arg in args],
+                    "kwargs": {key: summarize(val) for key, val in kwargs.items()},
+                    "s": time.perf_counter() - start,
+                }) + "\n")
+
+            if type(result).__module__.startswith("gspread"):
+                return RecordingProxy(result, self.bundle, type(result).__name__.lower())
+            return result
+
+        return call
+
+
+def recorded_call_seconds(bundle:str) -> dict:
+    # mean recorded duration per call name, e.g. "worksheet.update"
+    durations = {}
+    gspread_dir = os.path.join(bundle, "gspread")
+    for file in os.listdir(gspread_dir) if os.path.isdir(gspread_dir) else []:
+        with open(os.path.join(gspread_dir, file)) as f:
+            for line in f:
+                call = json.loads(line)
+                durations.setdefault(call["call"], []).append(call["s"])
+
+    return {call: sum(seconds) / len(seconds) for call, seconds in durations.items()}
+
+
+class ReplayWorksheet:
+    def __init__(self, client, sheet_name:str, title:str) -> None:
+        self.client = client
+        self.sheet_name = sheet_name
+        self.title = title
+
+    def clear(self):
+        self.client.sleep("worksheet.clear")
+
+    def update_title(self, title:str):
+        self.client.sleep("worksheet.update_title")
+        self.title = title
+
+    def update(self, values, *args, **kwargs):
+        self.client.sleep("worksheet.update")
+        write_json(os.path.join(self.client.out_dir, self.sheet_name, "%s.json" % self.title.replace("/", "_")), values)
+
+
+class ReplaySpreadsheet:
+    def __init__(self, client, name:str) -> None:
+        self.client = client
+        self.name = name
+        self.worksheets = [ReplayWorksheet(client, name, "Sheet1")] # like a newly created spreadsheet
+
+    def get_worksheet(self, idx:int):
+        self.client.sleep("spreadsheet.get_worksheet")
+        if idx >= len(self.worksheets):
+            raise gspread.WorksheetNotFound(idx)
+        return self.worksheets[idx]
+
+    def add_worksheet(self, title:str, rows=None, cols=None, *args, **kwargs):
+        self.client.sleep("spreadsheet.add_worksheet")
+        self.worksheets.append(ReplayWorksheet(self.client, self.name, title))
+        return self.worksheets[-1]
+
+
+class ReplayGspreadClient:
+    '''
+    Stands in for the gspread client. Uploads are written as JSON to out_dir so the
+    output of two replays can be diffed.
+    '''
+    def __init__(self, bundle:str, out_dir=None, latency=None) -> None:
+        self.out_dir = out_dir or os.path.join(replay_out(), "sheets")
+        self.latency = latency or Latency()
+        self.call_seconds = recorded_call_seconds(bundle)
+        self.sheets = {}
+
+    def sleep(self, call:str) -> None:
+        self.latency.sleep(self.call_seconds.get(call, 0.0))
+
+    def open(self, name:str):
+        self.sleep("client.open")
+        return self.sheets.setdefault(name, ReplaySpreadsheet(self, name))
+
+    def create(self, name:str, *args, **kwargs):
+        self.sleep("client.create")
+        return self.sheets.setdefault(name, ReplaySpreadsheet(self, name))
+
+
+def gspread_client(client_factory):
+    if os.environ.get("REPLAY_BUNDLE"):
+        return ReplayGspreadClient(os.environ["REPLAY_BUNDLE"])
+
+    client = client_factory()
+    if os.environ.get("RECORD_BUNDLE"):
+        os.makedirs(os.path.join(os.environ["RECORD_BUNDLE"], "gspread"), exist_ok=True)
+        return RecordingProxy(client, os.environ["RECORD_BUNDLE"], "client")
+    return client
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay a recorded processing run offline.")
+    parser.add_argument("bundle")
+    parser.add_argument("--tenant", default="default")
+    parser.add_argument("--latency", default="recorded", help='seconds per call, or "recorded"')
+    parser.add_argument("--out", default=None, help="where the caches and sheet uploads go")
+    args = parser.parse_args()
+
+    os.environ["REPLAY_BUNDLE"] = args.bundle
+    os.environ["REPLAY_LATENCY"] = args.latency
+    if args.out:
+        os.environ["REPLAY_OUT"] = args.out
+    os.environ.pop("RECORD_BUNDLE", None)
+
+    import application # the S3 client is picked when it is imported
+    start = time.perf_counter()
+    application.process_data(application.get_tenants()[args.tenant])
+    print("replayed in %.1fs, sheets written to %s" % (time.perf_counter() - start, os.path.join(replay_out(), "sheets")))
+
+
+if __name__ == "__main__":
+    main()
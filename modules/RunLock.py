@@ -0,0 +1,149 @@
+from modules.Manifest import connect
+from contextlib import contextmanager
+from modules import CONSTANTS
+import threading
+import json
+import time
+import uuid
+
+
+class RunLock:
+    '''
+    Host-wide single-flight lock for processing runs, kept in SQLite so every web worker
+    sees the same state. A key (a tenant) has at most one active run and one pending job.
+    Submissions while a run is active coalesce into the pending job, which the first
+    worker to call claim() after the run is released starts.
+
+    Active runs hold a lease the worker that started them renews with heartbeat(). A run
+    whose lease ran out (its worker died without releasing) can be taken over, so a crashed
+    worker can't block a tenant. Cancellation is a flag seen on the run's next heartbeat.
+    Connections must not cross a fork, run processes never open the lock.
+    '''
+    path = "run_lock.sqlite"
+
+    def __init__(self, path=None, lease_s=CONSTANTS.RUN_LEASE_SECONDS) -> None:
+        self.path = path or self.path
+        self.lease_s = lease_s
+        self.lock = threading.Lock()
+
+        self.conn = connect(self.path)
+        self.conn.isolation_level = None # transactions are begun explicitly
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS runs (
+                key TEXT PRIMARY KEY,
+                run_id TEXT,
+                job TEXT,
+                started_at REAL,
+                lease_until REAL,
+                cancel_at REAL,
+                pending TEXT,
+                pending_at REAL
+            )
+        ''')
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so read-then-write can't interleave across processes
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def submit(self, key:str, job:dict, preempt=False) -> None:
+        '''
+        Makes job the key's pending job, replacing any job already pending. preempt also
+        asks the active run to stop.
+        '''
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO runs (key) VALUES (?)", (key,))
+            conn.execute(
+                "UPDATE runs SET pending = ?, pending_at = COALESCE(pending_at, ?) WHERE key = ?",
+                (json.dumps(job), now, key)
+            )
+            if preempt:
+                self.request_cancel(key, conn, now)
+
+    def cancel(self, key:str) -> None:
+        with self.transaction() as conn:
+            self.request_cancel(key, conn, time.time())
+
+    def request_cancel(self, key:str, conn, now:float) -> None:
+        conn.execute(
+            "UPDATE runs SET cancel_at = COALESCE(cancel_at, ?) WHERE key = ? AND run_id IS NOT NULL",
+            (now, key)
+        )
+
+    def claim(self, max_active=None):
+        '''
+        Starts the longest waiting pending job whose key has no live run, unless max_active
+        runs are already live on the host. Returns (key, run_id, job), or None.
+        '''
+        now = time.time()
+        with self.transaction() as conn:
+            if max_active:
+                live = conn.execute("SELECT COUNT(*) FROM runs WHERE run_id IS NOT NULL AND lease_until > ?", (now,)).fetchone()[0]
+                if live >= max_active:
+                    return None
+
+            row = conn.execute(
+                "SELECT key, pending FROM runs WHERE pending IS NOT NULL AND (run_id IS NULL OR lease_until <= ?) "
+                "ORDER BY pending_at LIMIT 1", (now,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            key, job = row
+            run_id = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE runs SET run_id = ?, job = pending, started_at = ?, lease_until = ?, cancel_at = NULL, "
+                "pending = NULL, pending_at = NULL WHERE key = ?",
+                (run_id, now, now + self.lease_s, key)
+            )
+
+        return key, run_id, json.loads(job)
+
+    def heartbeat(self, key:str, run_id:str) -> str:
+        '''
+        Renews the run's lease. Returns "ok", "cancel" when the run was asked to stop,
+        or "lost" when the lease expired and the key was taken over.
+        '''
+        now = time.time()
+        with self.transaction() as conn:
+            renewed = conn.execute(
+                "UPDATE runs SET lease_until = ? WHERE key = ? AND run_id = ?",
+                (now + self.lease_s, key, run_id)
+            ).rowcount
+            if not renewed:
+                return "lost"
+            cancel_at = conn.execute("SELECT cancel_at FROM runs WHERE key = ?", (key,)).fetchone()[0]
+
+        return "ok" if cancel_at is None else "cancel"
+
+    def release(self, key:str, run_id:str) -> None:
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE runs SET run_id = NULL, job = NULL, started_at = NULL, lease_until = NULL, cancel_at = NULL "
+                "WHERE key = ? AND run_id = ?",
+                (key, run_id)
+            )
+
+    def status(self, key:str) -> dict:
+        with self.lock:
+            row = self.conn.execute("SELECT run_id, started_at, lease_until, cancel_at, pending FROM runs WHERE key = ?", (key,)).fetchone()
+
+        run_id, started_at, lease_until, cancel_at, pending = row or (None, None, None, None, None)
+        return {
+            "running": run_id is not None and lease_until > time.time(),
+            "queued": int(pending is not None),
+            "started_at": started_at,
+            "cancel_at": cancel_at,
+        }
+
+    def close(self) -> None:
+        self.conn.close()
+
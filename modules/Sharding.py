@@ -0,0 +1,110 @@
+from concurrent.futures import ProcessPoolExecutor, wait
+from modules.Cancellation import CancellationToken, RunCancelled
+from modules.MemoryBudget import default_budget
+from modules import DBXReader, Replay, Profiling
+from contextlib import nullcontext
+import argparse
+import os
+
+
+SHARDS_PATH = "shards"
+
+# the run's cancel event, handed to each worker process when it starts (Events can't be pickled into a task)
+shard_cancel_event = None
+
+
+def shard_dir(out_dir:str, shard:int) -> str:
+    return os.path.join(out_dir, "shard_%d" % shard)
+
+def init_worker(cancel_event) -> None:
+    global shard_cancel_event
+    shard_cancel_event = cancel_event
+
+def run_shard(link:str, access_token:str, shard:int, num_shards:int, out_dir=SHARDS_PATH, root="", storage=None, memory_budget=None, cancel_token=None, profile_dir=None) -> str:
+    '''
+    Processes only the project folders that hash to this shard and writes the
+    partial CS / CSSS / PR / PO outputs to out_dir/shard_<n>. storage replaces the
+    Dropbox client made from access_token, e.g. with a Storage.LocalBackend.
+    Nothing is committed here: the manifest rows travel with the partial, and the
+    checkpoints stay until merge_shards has written the merged outputs.
+    In a run_sharded worker, cancel_token defaults to the run's. profile_dir profiles the
+    shard into shard_<n>.pstats / .collapsed there, its file timings go with the partial.
+    '''
+    if cancel_token is None and shard_cancel_event is not None:
+        cancel_token = CancellationToken(shard_cancel_event)
+
+    storage = storage or Replay.dropbox_client(access_token)
+    dbx_reader = DBXReader.DbxDataRetriever(
+        link, storage, shard=(shard, num_shards), root=root, memory_budget=memory_budget, cancel_token=cancel_token
+    )
+    with Profiling.profile_run(name="shard_%d" % shard, run_dir=profile_dir) if profile_dir else nullcontext():
+        dbx_reader.create_datasets(consolidate=False)
+    return dbx_reader.dump_partial(shard_dir(out_dir, shard))
+
+def merge_shards(link:str, storage, partial_dirs:list, exact_stats=False, root="", progress=None) -> DBXReader.DbxDataRetriever:
+    '''
+    Combines the shard outputs, runs the cross-project outlier pass and caches the result.
+    finalize commits the shards' manifest rows and clears their checkpoints only after
+    df_caches has been written.
+    '''
+    dbx_reader = DBXReader.DbxDataRetriever(link, storage, root=root, progress=progress)
+    for partial_dir in partial_dirs:
+        dbx_reader.load_partial(partial_dir)
+
+    dbx_reader.finalize(exact_stats)
+
+    return dbx_reader
+
+def run_sharded(link:str, access_token:str, num_shards:int, out_dir=None, cancel_token=None, root="", progress=None, memory_budget=None, profile_dir=None) -> DBXReader.DbxDataRetriever:
+    '''
+    Local worker processes stand in for nodes. They share the run's cancel token, so on
+    cancellation running shards stop between projects like an unsharded run, keeping
+    their finished projects in the checkpoints, and shards that have not started are dropped.
+    The next sharded run skips the checkpointed projects, see restage_checkpoints.
+    memory_budget (bytes, default_budget() when None) is split evenly between the shards.
+    '''
+    cancel_token = cancel_token or CancellationToken()
+    out_dir = out_dir or os.path.join(root, SHARDS_PATH)
+    shard_budget = (memory_budget or default_budget()) // num_shards
+
+    with ProcessPoolExecutor(max_workers=num_shards, initializer=init_worker, initargs=(cancel_token.event,)) as executor:
+        futures = [
+            executor.submit(run_shard, link, access_token, shard, num_shards, out_dir, root, None, shard_budget, None, profile_dir)
+            for shard in range(num_shards)
+        ]
+        while wait(futures, timeout=1).not_done:
+            if cancel_token.cancelled:
+                executor.shutdown(cancel_futures=True) # returns once the running shards have stopped
+                raise RunCancelled()
+        partial_dirs = [future.result() for future in futures]
+
+    cancel_token.raise_if_cancelled()
+    return merge_shards(link, Replay.dropbox_client(access_token), partial_dirs, root=root, progress=progress)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run one shard of a processing run, or merge the shards.")
+    parser.add_argument("step", choices=["worker", "merge"])
+    parser.add_argument("--shard", type=int, default=0)
+    parser.add_argument("--num-shards", type=int, required=True)
+    parser.add_argument("--out", default=None)
+    parser.add_argument("--root", default="", help="the tenant's cache namespace")
+    parser.add_argument("--sheet", default=None, help="spreadsheet the merge publishes to")
+    args = parser.parse_args()
+
+    link = os.environ["dbx_link"]
+    access_token = os.environ["dbx_access_token"]
+    out_dir = args.out or os.path.join(args.root, SHARDS_PATH)
+
+    if args.step == "worker":
+        run_shard(link, access_token, args.shard, args.num_shards, out_dir, args.root)
+    else:
+        import application # publishing lives with the google helpers
+        application.populate_environ_tokens()
+        partial_dirs = [shard_dir(out_dir, shard) for shard in range(args.num_shards)]
+        dbx_reader = merge_shards(link, Replay.dropbox_client(access_token), partial_dirs, root=args.root)
+        application.publish_datasets(dbx_reader, args.sheet or application.DEFAULT_SHEET)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+from modules import CONSTANTS
+import numpy as np
+import pickle
+import os
+
+
+class QuantileSketch:
+    '''
+    Small mergeable t-digest style quantile sketch. Values are held as weighted
+    centroids that get compressed to roughly `compression` / 2 centroids, with
+    smaller centroids near the tails so the IQR bounds stay accurate. While the
+    sketch holds fewer than `compression` raw values its quantiles are exact.
+    '''
+    def __init__(self, compression=200) -> None:
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self) -> float:
+        return float(self.weights.sum())
+
+    def update(self, values) -> "QuantileSketch":
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values)]
+        if len(values):
+            self._add(values, np.ones(len(values)))
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+
+        return self
+
+    def merge(self, other:"QuantileSketch") -> "QuantileSketch":
+        if other.count:
+            self._add(other.means, other.weights)
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+
+        return self
+
+    def _add(self, means, weights) -> None:
+        means = np.concatenate([self.means, means])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(means, kind="mergesort")
+        self.means, self.weights = self._compress(means[order], weights[order])
+
+    def _compress(self, means, weights):
+        if len(means) <= self.compression:
+            return means, weights
+
+        total = weights.sum()
+        q = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1) # t-digest k1 scale function
+        buckets = np.floor(k - k.min()).astype(int)
+
+        new_weights = np.bincount(buckets, weights=weights)
+        keep = new_weights > 0
+        new_means = np.bincount(buckets, weights=means * weights)[keep] / new_weights[keep]
+
+        return new_means, new_weights[keep]
+
+    def quantile(self, q:float) -> float:
+        if not self.count:
+            return np.nan
+        if (self.weights == 1).all(): # still raw values, matches pd.Series.quantile
+            return float(np.quantile(self.means, q))
+
+        total = self.weights.sum()
+        positions = np.concatenate([[0], np.cumsum(self.weights) - self.weights / 2, [total]])
+        values = np.concatenate([[self.min], self.means, [self.max]])
+
+        return float(np.interp(q * total, positions, values))
+
+    def iqr_bounds(self, threshold=1.5) -> tuple:
+        q1 = self.quantile(0.25)
+        q3 = self.quantile(0.75)
+        cutoff = threshold * (q3 - q1)
+
+        return q1 - cutoff, q3 + cutoff
+
+
+class SectionStats:
+    '''
+    Persisted VARIANCE (%) sketches per dataset type and (sub) section. The max_open most
+    recently updated projects keep their own sketch, so a re-processed project replaces its
+    old values instead of being counted twice. Older projects are folded into a settled
+    sketch, which keeps the file's size independent of the project history; one of those
+    that is re-processed is counted twice until the next exact=True rebuild.
+    '''
+    path = "section_stats.pickle"
+
+    def __init__(self, path=None, max_open=CONSTANTS.SECTION_STATS_OPEN_PROJECTS) -> None:
+        self.path = path or self.path
+        self.max_open = max_open
+        self.projects = {} # (type, section) -> {project: QuantileSketch}, least recently updated first
+        self.settled = {} # (type, section) -> QuantileSketch of the projects folded out of projects
+        self.totals = {} # (type, section) -> QuantileSketch
+
+    def load(self) -> None:
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                state = pickle.load(f)
+            self.projects, self.totals = state[:2]
+            self.settled = state[2] if len(state) > 2 else {}
+            for key in self.projects:
+                self.settle(key)
+
+    def save(self) -> None:
+        with open(self.path, "wb") as f:
+            pickle.dump((self.projects, self.totals, self.settled), f)
+
+    def clear(self, _type=None) -> None:
+        for key in [key for key in self.totals if _type is None or key[0] == _type]:
+            del self.totals[key]
+            del self.projects[key]
+            self.settled.pop(key, None)
+
+    def settle(self, key:tuple) -> None:
+        projects = self.projects[key]
+        while len(projects) > self.max_open:
+            oldest = next(iter(projects))
+            self.settled.setdefault(key, QuantileSketch()).merge(projects.pop(oldest))
+
+    def update_project(self, _type:str, section, project:str, values) -> None:
+        key = (_type, section)
+        projects = self.projects.setdefault(key, {})
+        replacing = projects.pop(project, None) is not None
+        projects[project] = QuantileSketch().update(values)
+
+        if replacing or key not in self.totals:
+            self.totals[key] = QuantileSketch()
+            if key in self.settled:
+                self.totals[key].merge(self.settled[key])
+            for sketch in projects.values():
+                self.totals[key].merge(sketch)
+        else:
+            self.totals[key].merge(projects[project])
+
+        self.settle(key)
+
+    def update(self, _type:str, df, key:str, column="VARIANCE (%)") -> None:
+        for (section, project), values in df.groupby([key, "PROJECT NAME"], observed=True)[column]:
+            self.update_project(_type, section, project, values.to_numpy())
+
+    def rebuild(self, _type:str, df, key:str, column="VARIANCE (%)") -> None:
+        self.clear(_type)
+        self.update(_type, df, key, column)
+
+    def bounds(self, _type:str, section, threshold=1.5) -> tuple:
+        '''
+        Returns the (lower, upper) IQR outlier bounds and the median for a section.
+        '''
+        sketch = self.totals.get((_type, section))
+        if sketch is None:
+            return -np.inf, np.inf, np.nan
+
+        return (*sketch.iqr_bounds(threshold), sketch.quantile(0.5))
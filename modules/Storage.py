@@ -0,0 +1,208 @@
+from modules import CONSTANTS
+from datetime import datetime, timezone
+import dropbox
+import hashlib
+import shutil
+import io
+import os
+
+
+DBX_HASH_BLOCK = 4 * 2**20
+
+
+def dropbox_content_hash(file_obj) -> str:
+    '''
+    Dropbox's content_hash of a path or bytes: sha256 over the concatenated sha256
+    digests of each 4 MB block.
+    '''
+    block_hashes = hashlib.sha256()
+    with open(file_obj, "rb") if isinstance(file_obj, str) else io.BytesIO(file_obj) as f:
+        for block in iter(lambda: f.read(DBX_HASH_BLOCK), b""):
+            block_hashes.update(hashlib.sha256(block).digest())
+
+    return block_hashes.hexdigest()
+
+def parseable(name:str) -> bool:
+    return os.path.splitext(name)[1] in CONSTANTS.FILE_PREFERENCE
+
+def default_pool_size() -> int:
+    # one connection per thread of a default ThreadPoolExecutor, which is what the retriever uses
+    return min(32, (os.cpu_count() or 1) + 4)
+
+def dropbox_client(access_token:str, pool_size=None) -> dropbox.Dropbox:
+    '''
+    A Dropbox client on a connection-pooled session, so downloads reuse TLS connections.
+    The access token is refreshed automatically when dbx_refresh_token, dbx_app_key and
+    dbx_app_secret are in the environment.
+    '''
+    refresh = {}
+    if os.environ.get("dbx_refresh_token") and os.environ.get("dbx_app_key") and os.environ.get("dbx_app_secret"):
+        refresh = {
+            "oauth2_refresh_token": os.environ["dbx_refresh_token"],
+            "app_key": os.environ["dbx_app_key"],
+            "app_secret": os.environ["dbx_app_secret"],
+        }
+
+    return dropbox.Dropbox(
+        oauth2_access_token=access_token,
+        session=dropbox.create_session(max_connections=pool_size or default_pool_size()),
+        **refresh
+    )
+
+
+class Entry:
+    '''
+    A file or folder in a storage backend. Attribute names follow Dropbox's metadata,
+    which is what the manifest was written against.
+    '''
+    __slots__ = ("name", "path_display", "is_dir", "size", "content_hash", "rev", "client_modified")
+
+    def __init__(self, name:str, path_display:str, is_dir=False, size=None, content_hash=None, rev=None, client_modified=None) -> None:
+        self.name = name
+        self.path_display = path_display
+        self.is_dir = is_dir
+        self.size = size
+        self.content_hash = content_hash
+        self.rev = rev
+        self.client_modified = client_modified
+
+    def __repr__(self) -> str:
+        return "Entry(%r%s)" % (self.path_display, ", dir" if self.is_dir else "")
+
+
+class StorageBackend:
+    '''
+    Where the project folders are read from. Paths are absolute and "/"-separated.
+    '''
+    def list(self, path:str) -> list:
+        raise NotImplementedError
+
+    def stat(self, path:str) -> Entry:
+        raise NotImplementedError
+
+    def read(self, path:str) -> bytes:
+        raise NotImplementedError
+
+    def read_to_file(self, path:str, local_path:str) -> None:
+        with open(local_path, "wb") as f:
+            f.write(self.read(path))
+
+
+class DropboxBackend(StorageBackend):
+    def __init__(self, dbx) -> None:
+        self.dbx = dbx
+
+    @staticmethod
+    def to_entry(metadata):
+        if isinstance(metadata, dropbox.files.FolderMetadata):
+            return Entry(metadata.name, metadata.path_display, is_dir=True)
+        if isinstance(metadata, dropbox.files.FileMetadata):
+            return Entry(
+                metadata.name, metadata.path_display, size=metadata.size, content_hash=metadata.content_hash,
+                rev=metadata.rev, client_modified=metadata.client_modified
+            )
+        return None # deleted
+
+    def list(self, path:str) -> list:
+        res = self.dbx.files_list_folder(path)
+        entries = list(res.entries)
+        while res.has_more:
+            res = self.dbx.files_list_folder_continue(res.cursor)
+            entries += res.entries
+
+        return [entry for entry in map(self.to_entry, entries) if entry]
+
+    def stat(self, path:str) -> Entry:
+        return self.to_entry(self.dbx.files_get_metadata(path))
+
+    def read(self, path:str) -> bytes:
+        _, response = self.dbx.files_download(path)
+        return response.content
+
+    def read_to_file(self, path:str, local_path:str) -> None:
+        self.dbx.files_download_to_file(local_path, path)
+
+
+class LocalBackend(StorageBackend):
+    '''
+    A local directory laid out like the Dropbox folder. Only files the readers can parse
+    are hashed, so archived media costs nothing. Reads to a file are hard links when possible.
+    '''
+    def __init__(self, root_dir:str) -> None:
+        self.root_dir = os.path.abspath(root_dir)
+
+    def local_path(self, path:str) -> str:
+        return os.path.join(self.root_dir, path.strip("/"))
+
+    def to_entry(self, local_path:str, path:str) -> Entry:
+        name = os.path.basename(local_path)
+        if os.path.isdir(local_path):
+            return Entry(name, path, is_dir=True)
+
+        stat = os.stat(local_path)
+        return Entry(
+            name, path, size=stat.st_size, rev="%09x" % stat.st_mtime_ns,
+            content_hash=dropbox_content_hash(local_path) if parseable(name) else None,
+            client_modified=datetime.fromtimestamp(stat.st_mtime, timezone.utc).replace(tzinfo=None, microsecond=0),
+        )
+
+    def list(self, path:str) -> list:
+        local_path = self.local_path(path)
+        return [
+            self.to_entry(os.path.join(local_path, name), "%s/%s" % (path.rstrip("/"), name))
+            for name in sorted(os.listdir(local_path)) if not name.startswith(".")
+        ]
+
+    def stat(self, path:str) -> Entry:
+        return self.to_entry(self.local_path(path), path)
+
+    def read(self, path:str) -> bytes:
+        with open(self.local_path(path), "rb") as f:
+            return f.read()
+
+    def read_to_file(self, path:str, local_path:str) -> None:
+        try:
+            os.link(self.local_path(path), local_path)
+        except OSError:
+            shutil.copyfile(self.local_path(path), local_path)
+
+
+class MemoryBackend(StorageBackend):
+    '''
+    Files held in a dict of path -> bytes, folders are implied by the paths.
+    '''
+    def __init__(self, files=None) -> None:
+        self.files = {} # path -> (bytes, modified)
+        for path, data in (files or {}).items():
+            self.write(path, data)
+
+    def write(self, path:str, data:bytes, modified=None) -> None:
+        self.files["/" + path.strip("/")] = (data, modified or datetime.utcnow().replace(microsecond=0))
+
+    def to_entry(self, path:str) -> Entry:
+        name = path.rsplit("/", 1)[-1]
+        if not path in self.files:
+            return Entry(name, path, is_dir=True)
+
+        data, modified = self.files[path]
+        content_hash = dropbox_content_hash(data)
+        return Entry(name, path, size=len(data), content_hash=content_hash, rev=content_hash[:16], client_modified=modified)
+
+    def list(self, path:str) -> list:
+        prefix = path.rstrip("/") + "/"
+        children = {prefix + rest.split("/")[0] for rest in (p[len(prefix):] for p in self.files if p.startswith(prefix))}
+        return [self.to_entry(child) for child in sorted(children)]
+
+    def stat(self, path:str) -> Entry:
+        path = "/" + path.strip("/")
+        if not path in self.files and not any(p.startswith(path + "/") for p in self.files):
+            raise FileNotFoundError(path)
+        return self.to_entry(path)
+
+    def read(self, path:str) -> bytes:
+        return self.files["/" + path.strip("/")][0]
+
+
+def as_backend(storage) -> StorageBackend:
+    # a bare Dropbox client (or a recording / replaying one) is wrapped
+    return storage if isinstance(storage, StorageBackend) else DropboxBackend(storage)
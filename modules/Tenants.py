@@ -0,0 +1,138 @@
+from modules.Cancellation import CancellationToken
+from modules.MemoryBudget import default_budget
+from modules.RunLock import RunLock
+from modules import CONSTANTS
+import multiprocessing
+import threading
+import hashlib
+import time
+import re
+import os
+
+
+TENANTS_PATH = "tenants"
+DEFAULT_TENANT = "default"
+
+
+def tenant_root(tenant_id:str) -> str:
+    '''
+    Cache namespace of a tenant. The default tenant keeps the top level caches
+    it had before there were tenants. Ids that aren't safe as a directory name get a
+    hash of the raw id appended after a ".", which safe ids can't contain, so two ids
+    never share a namespace.
+    '''
+    if tenant_id == DEFAULT_TENANT:
+        return ""
+    if re.fullmatch(r"[A-Za-z0-9_-]+", tenant_id):
+        return os.path.join(TENANTS_PATH, tenant_id)
+
+    digest = hashlib.sha256(tenant_id.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(TENANTS_PATH, "%s.%s" % (re.sub(r"[^A-Za-z0-9_-]+", "_", tenant_id), digest))
+
+def run_job(target, parent_pid:int, kwargs:dict) -> None:
+    # the run's worker renews its lease, an orphaned run is asked to stop right away instead
+    # of running on unleased once the lease lapses
+    cancel_token = kwargs["cancel_token"]
+    def watch_parent():
+        while not cancel_token.cancelled:
+            if os.getppid() != parent_pid:
+                print("worker %d is gone, stopping the run" % parent_pid)
+                cancel_token.cancel()
+            time.sleep(1)
+
+    threading.Thread(target=watch_parent, daemon=True).start()
+    target(**kwargs)
+
+
+class TenantScheduler:
+    '''
+    Runs processing jobs for several tenants as separate processes. Runs and queued jobs are
+    kept in a RunLock shared by every web worker on the host, so a tenant has one active run
+    and one pending job however many workers receive its webhooks, and at most max_workers
+    runs are live on the host. Pending jobs start oldest first, so one tenant's backfill
+    can't starve the rest. Each worker starts the jobs it claims from its dispatcher thread,
+    heartbeats their leases while their processes are alive, and passes a cancellation on
+    to them within poll_s.
+
+    target is called in the new process with the job's kwargs plus cancel_token and
+    memory_budget, the global memory budget split evenly between the workers.
+    '''
+    def __init__(self, target, max_workers=None, grace_s=120, poll_s=1.0, run_lock=None) -> None:
+        self.target = target
+        self.max_workers = max_workers or int(os.environ.get("MAX_WORKERS", CONSTANTS.TENANT_WORKERS))
+        self.memory_budget = default_budget() // self.max_workers
+        self.grace_s = grace_s
+        self.poll_s = poll_s
+        self.run_lock = run_lock or RunLock()
+
+        self.cond = threading.Condition()
+        self.running = {} # tenant_id -> (process, run_id, cancel_token), the runs this worker started
+        self.heartbeat_s = self.run_lock.lease_s / 3
+        self.last_heartbeat = 0
+
+        self.thread = threading.Thread(target=self.dispatch_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, tenant_id:str, job:dict, preempt=False) -> bool:
+        '''
+        Queues a job for a tenant, replacing a job already pending since that run would see
+        the same changes. preempt also cancels the tenant's current run, on whichever worker.
+        '''
+        self.run_lock.submit(tenant_id, job, preempt)
+        with self.cond:
+            self.cond.notify()
+        return True
+
+    def cancel(self, tenant_id:str) -> None:
+        # the run stops at its next checkpoint, or is terminated by its worker after the grace period
+        self.run_lock.cancel(tenant_id)
+
+    def status(self, tenant_id:str) -> dict:
+        status = self.run_lock.status(tenant_id)
+        return {"running": status["running"], "queued": status["queued"], "run_started_at": status["started_at"]}
+
+    def dispatch_loop(self) -> None:
+        while True:
+            with self.cond:
+                self.reap()
+                self.dispatch()
+                self.cond.wait(self.poll_s)
+
+    def reap(self) -> None:
+        heartbeat = time.time() - self.last_heartbeat > self.heartbeat_s
+        if heartbeat:
+            self.last_heartbeat = time.time()
+
+        for tenant_id, (process, run_id, cancel_token) in list(self.running.items()):
+            if not process.is_alive():
+                process.join()
+                self.run_lock.release(tenant_id, run_id)
+                del self.running[tenant_id]
+            else:
+                state = self.run_lock.heartbeat(tenant_id, run_id) if heartbeat else "ok"
+                self.watch(tenant_id, process, run_id, cancel_token, state)
+
+    def watch(self, tenant_id:str, process, run_id:str, cancel_token, state:str) -> None:
+        # cancellation is checked on every poll, so a preemption reaches the run right away,
+        # only renewing the lease waits for the heartbeat. A cancelled run keeps its lease
+        # while it winds down, so its replacement waits for it.
+        cancel_at = self.run_lock.status(tenant_id)["cancel_at"]
+        if (state == "lost" or cancel_at) and not cancel_token.cancelled:
+            print("run %s of %s: %s, stopping" % (run_id, tenant_id, "lost" if state == "lost" else "cancel"))
+            cancel_token.cancel()
+
+        if state == "lost" or (cancel_at and time.time() - cancel_at > self.grace_s):
+            process.terminate()
+
+    def dispatch(self) -> None:
+        while len(self.running) < self.max_workers:
+            claimed = self.run_lock.claim(self.max_workers)
+            if claimed is None:
+                return
+
+            tenant_id, run_id, job = claimed
+            cancel_token = CancellationToken()
+            kwargs = {**job, "cancel_token": cancel_token, "memory_budget": self.memory_budget}
+            process = multiprocessing.Process(target=run_job, args=(self.target, os.getpid(), kwargs))
+            process.start()
+            self.running[tenant_id] = (process, run_id, cancel_token)
@@ -0,0 +1,189 @@
+from logging.handlers import RotatingFileHandler
+from modules.Cancellation import RunCancelled
+from contextlib import contextmanager
+from contextvars import ContextVar
+from modules import CONSTANTS
+import pandas as pd
+import argparse
+import logging
+import glob
+import json
+import time
+import re
+import os
+
+
+TRACES_PATH = "traces"
+
+# the file the current thread is working on, so readers deep in the call stack can
+# report the errors they recover from without having it passed down to them
+current_file = ContextVar("current_file", default=None)
+
+
+def trace_path(root="", shard=None) -> str:
+    name = "trace.jsonl" if shard is None else "trace_shard_%d.jsonl" % shard
+    return os.path.join(root, TRACES_PATH, name)
+
+def note_error(error:Exception, phase:str) -> None:
+    '''
+    Records an exception that was caught and worked around on the file being processed.
+    '''
+    trace = current_file.get()
+    if trace is not None:
+        trace.recovered(error, phase)
+
+def name_template(path:str) -> str:
+    # "23-104 Nike PO Log v2.xlsx" -> "#-# nike po log v#.xlsx"
+    stem, extension = os.path.splitext(os.path.basename(path).lower())
+    return re.sub(r"\d+", "#", stem) + extension
+
+
+class FileTrace:
+    '''
+    What happened to one file during a run: its detected type and chosen parser, time spent
+    per phase (nested phases are subtracted from the enclosing one), rows produced, the count
+    of numeric values per column that could not be parsed, and the class of the error that
+    failed it or that a reader recovered from.
+    '''
+    def __init__(self, path:str, project:str, size=None, content_hash=None, run=None) -> None:
+        self.record = {
+            "run": run,
+            "project": project,
+            "path": path,
+            "size": size,
+            "content_hash": content_hash,
+            "type": None,
+            "parser": None,
+            "phases": {},
+            "rows": {},
+            "unparsed": {},
+            "error": None,
+            "error_phase": None,
+            "recovered": [],
+        }
+        self.nested = []
+
+    def set(self, **fields) -> None:
+        self.record.update(fields)
+
+    @contextmanager
+    def phase(self, name:str):
+        token = current_file.set(self)
+        self.nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield self
+        except Exception as e:
+            self.fail(e, name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.nested.pop()
+            if self.nested:
+                self.nested[-1] += elapsed
+            phases = self.record["phases"]
+            phases[name] = round(phases.get(name, 0) + elapsed - nested, 4)
+            current_file.reset(token)
+
+    def fail(self, error:Exception, phase:str) -> None:
+        # the innermost phase sees the error first and keeps it
+        if not isinstance(error, RunCancelled) and self.record["error"] is None:
+            self.record["error"] = type(error).__name__
+            self.record["error_phase"] = phase
+            self.record["message"] = str(error)[:200]
+
+    def recovered(self, error:Exception, phase:str) -> None:
+        self.record["recovered"].append({"phase": phase, "error": type(error).__name__})
+
+
+class TraceLog:
+    '''
+    Appends FileTraces as JSON lines to a size-rotated file (trace.jsonl, trace.jsonl.1, ...).
+    Each process writes its own file, sharded workers get one per shard.
+    '''
+    def __init__(self, path:str, max_bytes=CONSTANTS.TRACE_MAX_BYTES, backups=CONSTANTS.TRACE_BACKUPS) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.logger = logging.getLogger("trace.%s" % os.path.abspath(path))
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+    def write(self, trace:FileTrace) -> None:
+        self.logger.info(json.dumps({"ts": round(time.time(), 3), **trace.record}, default=str))
+
+    def close(self) -> None:
+        for handler in list(self.logger.handlers):
+            handler.close()
+            self.logger.removeHandler(handler)
+
+
+# SUMMARY ————————————————————————————————————————————————————————————————————————————————————————————————————————
+def read_traces(root="", last_run=False) -> pd.DataFrame:
+    records = []
+    for path in glob.glob(os.path.join(root, TRACES_PATH, "trace*.jsonl*")):
+        with open(path) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+
+    traces = pd.DataFrame(records)
+    if traces.empty:
+        return traces
+
+    if last_run:
+        traces = traces[traces.run == traces.sort_values("ts").run.iloc[-1]]
+
+    traces["seconds"] = traces.phases.apply(lambda phases: sum(phases.values()))
+    traces["failed"] = traces.error.notna() | traces.recovered.apply(bool)
+    traces["error_class"] = traces.error.fillna(traces.recovered.apply(lambda r: r[0]["error"] if r else None))
+    return traces
+
+def summarize(root="", by="parser", top_n=10, last_run=False) -> dict:
+    '''
+    Ranks templates, the parser a file went through or its file name with the numbers taken
+    out (by="name"), by p95 seconds and by the share of files that failed or needed recovering.
+    Files that were only classified are grouped as "<type><extension>".
+    '''
+    traces = read_traces(root, last_run)
+    if traces.empty:
+        return {"slowest": traces, "failing": traces}
+
+    if by == "name":
+        traces["template"] = traces.path.apply(name_template)
+    else:
+        traces["template"] = traces.parser.fillna(traces.type.fillna("?") + traces.path.str.extract(r"(\.\w+)$", expand=False).fillna(""))
+
+    groups = traces.groupby("template")
+    summary = pd.DataFrame({
+        "files": groups.size(),
+        "mean_s": groups.seconds.mean().round(3),
+        "p95_s": groups.seconds.quantile(0.95).round(3),
+        "max_s": groups.seconds.max().round(3),
+        "failures": groups.failed.sum(),
+        "failure_rate": groups.failed.mean().round(3),
+        "top_error": groups.error_class.agg(lambda errors: errors.mode().iloc[0] if errors.notna().any() else None),
+    })
+
+    return {
+        "slowest": summary.sort_values("p95_s", ascending=False).head(top_n),
+        "failing": summary[summary.failures > 0].sort_values(["failure_rate", "failures"], ascending=False).head(top_n),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rank the slowest and most failure-prone file templates from the trace log.")
+    parser.add_argument("--root", default="", help="the tenant's cache namespace")
+    parser.add_argument("--by", choices=["parser", "name"], default="parser")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--last-run", action="store_true", help="only the most recent run")
+    args = parser.parse_args()
+
+    summary = summarize(args.root, args.by, args.top, args.last_run)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print("SLOWEST\n", summary["slowest"], "\n\nMOST FAILURES\n", summary["failing"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("camelot")
+pytest.importorskip("fitz")
+
+from modules.DBXReader import DbxDataRetriever
+from modules.Storage import MemoryBackend
+
+
+def test_copied_log_is_parsed_once(tmp_path):
+    log = b"the same purchase order log"
+    storage = MemoryBackend({
+        "/23 Alpha/PO Log.xlsx": log,
+        "/23 Beta/PO Log.xlsx": log,
+        "/23 Gamma/PO Log copy.xlsx": log,
+    })
+    retriever = DbxDataRetriever("home/", storage, root=str(tmp_path))
+
+    calls = []
+    def read_po(file_obj, extension):
+        calls.append(file_obj)
+        return pd.DataFrame({"LINE": [100], "SECTION": ["A"], "PAYEE": ["Acme"], "ACTUAL": [1.0]})
+    retriever.readers["PO"] = read_po
+
+    retriever.create_datasets(consolidate=False)
+
+    assert len(calls) == 1
+    assert sorted(df["PROJECT NAME"][0] for df in retriever.datasets["PO"]) == ["23 Alpha", "23 Beta", "23 Gamma"]
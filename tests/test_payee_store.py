@@ -0,0 +1,14 @@
+import pandas as pd
+
+from modules.PayeeStore import PayeeStore
+
+
+def test_similar_payees_are_review_candidates(tmp_path):
+    store = PayeeStore(str(tmp_path / "payees.sqlite"))
+    resolved = store.resolve_many(pd.Series(["Bob Smith", "Rob Smith", "Panavision", "Panavision Hollywood", "BOB  SMITH"]))
+
+    assert resolved.tolist() == ["Bob Smith", "Rob Smith", "Panavision", "Panavision Hollywood", "Bob Smith"]
+
+    store.flush()
+    review = store.review()
+    assert sorted(zip(review.raw, review.matched)) == [("Panavision Hollywood", "panavision"), ("Rob Smith", "bob smith")]
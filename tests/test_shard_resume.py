@@ -0,0 +1,43 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("camelot")
+pytest.importorskip("fitz")
+
+from modules.Cancellation import CancellationToken, RunCancelled
+from modules.DBXReader import DbxDataRetriever
+from modules.Storage import MemoryBackend
+
+
+def test_resumed_shard_skips_checkpointed_projects(tmp_path):
+    storage = MemoryBackend({
+        "/23 %s/PO Log.xlsx" % name: ("purchase order log of %s" % name).encode()
+        for name in ["Alpha", "Beta", "Gamma"]
+    })
+
+    def shard_retriever(calls, cancel_after=None):
+        token = CancellationToken()
+        retriever = DbxDataRetriever(
+            "home/", storage, shard=(0, 1), root=str(tmp_path), cancel_token=token,
+            memory_budget=1, # one project at a time
+        )
+        def read_po(file_obj, extension):
+            calls.append(file_obj)
+            if len(calls) == cancel_after:
+                token.cancel()
+            return pd.DataFrame({"LINE": [100], "SECTION": ["A"], "PAYEE": ["Acme"], "ACTUAL": [1.0]})
+        retriever.readers["PO"] = read_po
+        return retriever
+
+    first = []
+    with pytest.raises(RunCancelled):
+        shard_retriever(first, cancel_after=2).create_datasets(consolidate=False)
+    assert len(first) == 2
+
+    resumed = []
+    retriever = shard_retriever(resumed)
+    retriever.create_datasets(consolidate=False)
+
+    assert len(resumed) == 1
+    assert len(retriever.manifest.pending) == 3 # all three go out with the partial
+    assert sorted(df["PROJECT NAME"][0] for df in retriever.datasets["PO"]) == ["23 Alpha", "23 Beta", "23 Gamma"]